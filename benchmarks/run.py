@@ -0,0 +1,292 @@
+"""
+Benchmarks the render stages and the Google Calendar sync over synthetic
+calendars and writes the timings as JSON so runs on different commits can
+be compared. Run from the repository's root directory:
+
+    python3 -m benchmarks.run --output results.json
+"""
+
+import argparse
+import collections
+import datetime
+import json
+import platform
+import statistics
+import subprocess
+import sys
+import time
+
+import cairocffi as cairo
+import dotmap
+
+from config import cfg
+from renderconfig import compile_config
+from textcache import TextSpriteCache
+
+import main
+import plugins.googlecalendarplugin as googlecalendarplugin
+
+from benchmarks import synthetic
+
+Case = collections.namedtuple("Case", ["events", "days", "all_day_fraction"])
+
+
+class Scenario(object):
+    """
+    Everything a benchmark needs for one Case: a synthetic calendar loaded
+    into a GoogleCalendarPlugin, the timeline items of the frame, the
+    (compiled) configuration and a surface to render on.
+    """
+
+    def __init__(self, case, now):
+        self.case = case
+        self.now = now
+        self.timespan = datetime.timedelta(days=case.days)
+        self.end = now + self.timespan
+
+        self.calendars = synthetic.generate_calendars(
+            case.events, now, case.days, case.all_day_fraction)
+
+        self.config = cfg.copy()
+        self.config.timespan = self.timespan
+        self.render_config = compile_config(self.config)
+
+        self.plugin = Scenario.create_plugin(case)
+        for calendar_id, events in self.calendars.items():
+            self.plugin.load_events(calendar_id, events)
+        self.plugins = [self.plugin]
+
+        self.events = main.get_timeline_events(self.plugins, now,
+                                               self.timespan)
+
+        self.surface = cairo.ImageSurface(cairo.FORMAT_ARGB32,
+                                          self.render_config.window.width,
+                                          self.render_config.window.height)
+        self.context = cairo.Context(self.surface)
+
+        # Render text the way Renderer does.
+        main.CairoUtils.text_cache = TextSpriteCache(
+            self.render_config.text_cache_max_bytes)
+
+    @staticmethod
+    def create_plugin(case):
+        """ Return a GoogleCalendarPlugin that is never started. """
+        return googlecalendarplugin.GoogleCalendarPlugin(dotmap.DotMap({
+            'page_size': 250,
+            'sync_horizon_in_days': case.days,
+            'event_store_file': None}))
+
+    def create_timeline(self):
+        timeline = main.Timeline(self.render_config.timeline, self.plugins)
+        timeline.set_timeline_events(self.events)
+        return timeline
+
+
+def bench_timeline(scenario):
+    timeline = scenario.create_timeline()
+    return lambda: timeline.render(scenario.context, scenario.now,
+                                   scenario.end)
+
+
+def bench_plugin_events(scenario):
+    timeline = scenario.create_timeline()
+    return lambda: timeline.render_plugin_events(scenario.context,
+                                                 scenario.now, scenario.end)
+
+
+def bench_day_labels(scenario):
+    timeline = scenario.create_timeline()
+    return lambda: timeline.render_day_labels(scenario.context, scenario.now,
+                                              scenario.end)
+
+
+def bench_event_list(scenario):
+    event_list = main.EventList(scenario.render_config.event_list)
+    event_list.set_timeline_events(scenario.events)
+    return lambda: event_list.render(scenario.context, scenario.now)
+
+
+def bench_clock(scenario):
+    clock = main.Clock(scenario.render_config.clock)
+    return lambda: clock.render(scenario.context, scenario.now)
+
+
+def bench_renderer_full(scenario):
+    """ Redraw every layer of the frame. """
+    renderer = main.Renderer(scenario.config, scenario.plugins,
+                             scenario.surface)
+    renderer.set_timeline_events(scenario.events)
+
+    def run():
+        renderer.invalidate()
+        renderer.render(scenario.now)
+
+    return run
+
+
+def bench_renderer_minute(scenario):
+    """ A frame one minute after the previous one, as done by render_frame. """
+    renderer = main.Renderer(scenario.config, scenario.plugins,
+                             scenario.surface)
+    minutes = [0]
+
+    def run():
+        now = scenario.now + datetime.timedelta(minutes=minutes[0])
+        minutes[0] += 1
+        renderer.set_timeline_events(main.get_timeline_events(
+            scenario.plugins, now, scenario.timespan))
+        renderer.render(now)
+
+    return run
+
+
+def bench_get_events_full(scenario):
+    """ The first sync of a plugin. """
+    service = synthetic.StubService(scenario.calendars)
+    calendars = service.calendars()
+
+    def run():
+        plugin = Scenario.create_plugin(scenario.case)
+        plugin.get_events(service, calendars, scenario.now, scenario.end)
+
+    return run
+
+
+def bench_get_events_incremental(scenario):
+    """ A sync with sync tokens after one event has changed. """
+    service = synthetic.StubService(scenario.calendars)
+    calendars = service.calendars()
+    plugin = Scenario.create_plugin(scenario.case)
+    plugin.get_events(service, calendars, scenario.now, scenario.end)
+    changes = [0]
+
+    def run():
+        calendar_id = calendars[changes[0] % len(calendars)]['id']
+        changes[0] += 1
+        event = dict(scenario.calendars[calendar_id][0]) \
+            if scenario.calendars[calendar_id] else None
+        if event is not None:
+            event['summary'] = 'Changed {}'.format(changes[0])
+            service.change_event(calendar_id, event)
+        plugin.get_events(service, calendars, scenario.now, scenario.end)
+
+    return run
+
+
+BENCHMARKS = collections.OrderedDict([
+    ('timeline', bench_timeline),
+    ('plugin_events', bench_plugin_events),
+    ('day_labels', bench_day_labels),
+    ('event_list', bench_event_list),
+    ('clock', bench_clock),
+    ('renderer_full', bench_renderer_full),
+    ('renderer_minute', bench_renderer_minute),
+    ('get_events_full', bench_get_events_full),
+    ('get_events_incremental', bench_get_events_incremental),
+])
+
+
+def time_calls(fn, repeat):
+    """
+    Call fn repeat times.
+    :return: A dictionary of timings in seconds. The first call (which may
+    fill caches) is reported on its own and left out of the other figures
+    unless fn is only called once.
+    """
+    times = []
+
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start)
+
+    steady = times[1:] or times
+
+    return collections.OrderedDict([
+        ('first_s', times[0]),
+        ('min_s', min(steady)),
+        ('median_s', statistics.median(steady)),
+        ('mean_s', statistics.mean(steady)),
+        ('max_s', max(steady)),
+    ])
+
+
+def get_commit():
+    """ Return the git commit being benchmarked (or None). """
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', 'HEAD'],
+            stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_benchmarks(names, cases, repeat, now):
+    """ Run the named benchmarks for every case and return the results. """
+    results = []
+
+    for case in cases:
+        scenario = Scenario(case, now)
+
+        for name in names:
+            print('{} events={} days={} all_day_fraction={}'.format(
+                name, *case), file=sys.stderr)
+
+            result = collections.OrderedDict([
+                ('benchmark', name),
+                ('events', case.events),
+                ('days', case.days),
+                ('all_day_fraction', case.all_day_fraction),
+                ('timeline_items', len(scenario.events)),
+                ('repeat', repeat)])
+            result.update(time_calls(BENCHMARKS[name](scenario), repeat))
+            results.append(result)
+
+    return results
+
+
+def parse_list(convert):
+    return lambda s: [convert(value) for value in s.split(',')]
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--benchmarks', type=parse_list(str),
+                        default=list(BENCHMARKS.keys()),
+                        help='comma-separated subset of: ' + ', '.join(BENCHMARKS))
+    parser.add_argument('--events', type=parse_list(int),
+                        default=[10, 100, 1000, 10000])
+    parser.add_argument('--days', type=parse_list(int), default=[1, 7, 60])
+    parser.add_argument('--all-day-fractions', type=parse_list(float),
+                        default=[0.0, 0.25, 1.0])
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--now', default=datetime.datetime(2018, 1, 1, 9, 30),
+                        type=lambda s: datetime.datetime.strptime(s, '%Y-%m-%dT%H:%M'))
+    parser.add_argument('--output', default='-',
+                        help="file to write the results to ('-' for stdout)")
+    args = parser.parse_args()
+
+    for name in args.benchmarks:
+        if name not in BENCHMARKS:
+            parser.error("unknown benchmark '{}'".format(name))
+
+    cases = [Case(events, days, fraction)
+             for events in args.events
+             for days in args.days
+             for fraction in args.all_day_fractions]
+
+    report = collections.OrderedDict([
+        ('commit', get_commit()),
+        ('python', platform.python_version()),
+        ('machine', platform.machine()),
+        ('now', args.now.isoformat()),
+        ('results', run_benchmarks(args.benchmarks, cases, args.repeat,
+                                   args.now))])
+
+    if args.output == '-':
+        json.dump(report, sys.stdout, indent=1)
+        print()
+    else:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=1)
@@ -0,0 +1,249 @@
+"""
+Runs the render loop for simulated weeks at full speed, against a fake clock
+and a Google Calendar plugin synced from a synthetic calendar, and fails if
+memory keeps growing. Run from the repository's root directory:
+
+    python3 -m benchmarks.soak --days 14 --output soak.json
+
+Memory is measured with tracemalloc (Python allocations) and the resident
+set size. Both are compared to a baseline taken after a warm-up, so that
+caches that fill up once aren't mistaken for leaks, and the allocation sites
+that grew most are reported.
+"""
+
+import argparse
+import collections
+import datetime
+import gc
+import json
+import os
+import platform
+import random
+import sys
+import time
+import tracemalloc
+
+import cairocffi as cairo
+import dotmap
+
+from config import cfg
+
+import main
+import plugins.googlecalendarplugin as googlecalendarplugin
+
+from benchmarks import run
+from benchmarks import synthetic
+
+
+def get_rss_kb():
+    """ Return the resident set size in kB (or None if it isn't known). """
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return None
+
+
+# Allocations made by the harness itself (such as the synthetic service's
+# log of changes) or by tracemalloc are left out.
+SNAPSHOT_FILTERS = [
+    tracemalloc.Filter(False, tracemalloc.__file__),
+    tracemalloc.Filter(False, '<frozen importlib._bootstrap>'),
+    tracemalloc.Filter(False, '<unknown>'),
+    tracemalloc.Filter(False, os.path.join('*', 'benchmarks', '*')),
+]
+
+
+def take_snapshot():
+    gc.collect()
+    return tracemalloc.take_snapshot().filter_traces(SNAPSHOT_FILTERS)
+
+
+def get_top_growth(snapshot, baseline, count):
+    """ Return the count allocation sites that grew most since baseline. """
+    key_type = 'lineno' if tracemalloc.get_traceback_limit() == 1 \
+        else 'traceback'
+
+    return [collections.OrderedDict([
+                ('site', ['{}:{}'.format(frame.filename, frame.lineno)
+                          for frame in stat.traceback]),
+                ('size_diff_kb', stat.size_diff / 1024),
+                ('count_diff', stat.count_diff)])
+            for stat in snapshot.compare_to(baseline, key_type)[:count]
+            if stat.size_diff > 0]
+
+
+class Soak(object):
+    """
+    Renders a frame for every step of a fake clock, syncing the plugin with
+    a synthetic calendar in which a few events change before every sync.
+    Every component draws the fake clock's time, so the heading and the
+    event list's day headings change at each simulated midnight.
+    """
+
+    def __init__(self, args):
+        self.args = args
+        self.config = cfg.copy()
+
+        days = args.days + self.config.timespan.days + 1
+        self.calendars = synthetic.generate_calendars(
+            args.events_per_day * days, args.start, days,
+            args.all_day_fraction)
+        self.service = synthetic.StubService(self.calendars)
+        self.calendar_list = self.service.calendars()
+        self.rng = random.Random(0)
+        self.changes = 0
+
+        self.plugin = googlecalendarplugin.GoogleCalendarPlugin(dotmap.DotMap({
+            'page_size': 250,
+            'sync_horizon_in_days': args.sync_horizon_in_days,
+            'event_store_file': None}))
+        self.plugins = [self.plugin]
+
+        self.surface = cairo.ImageSurface(cairo.FORMAT_ARGB32,
+                                          self.config.window.width,
+                                          self.config.window.height)
+        self.renderer = main.Renderer(self.config, self.plugins,
+                                      self.surface)
+        self.frames = 0
+        self.last_sync = None
+
+    def sync(self, now):
+        """ Change some events and bring the plugin up to date. """
+        for _ in range(self.args.changes_per_sync):
+            calendar_id = self.rng.choice(sorted(self.calendars))
+            if not self.calendars[calendar_id]:
+                continue
+            self.changes += 1
+            event = dict(self.rng.choice(self.calendars[calendar_id]))
+            event['summary'] = 'Changed {}'.format(self.changes)
+            self.service.change_event(calendar_id, event)
+
+        self.plugin.get_events(self.service, self.calendar_list, now,
+                               now + self.config.timespan)
+
+    def run_until(self, now, end):
+        """ Render frames from now until end and return the time reached. """
+        step = datetime.timedelta(seconds=self.args.step_seconds)
+        sync_interval = datetime.timedelta(
+            minutes=self.args.sync_interval_minutes)
+
+        while now < end:
+            if self.last_sync is None or now - self.last_sync >= sync_interval:
+                self.sync(now)
+                self.last_sync = now
+
+            main.render_frame(self.config, self.plugins, self.renderer,
+                              lambda damage: None, now)
+            self.frames += 1
+            now += step
+
+        return now
+
+
+def soak(args):
+    """ Run the soak test and return the report. """
+    tracemalloc.start(args.traceback_frames)
+    started = time.perf_counter()
+
+    harness = Soak(args)
+    end = args.start + datetime.timedelta(days=args.days)
+    sample_interval = datetime.timedelta(hours=args.sample_hours)
+    samples = []
+
+    def sample(now):
+        gc.collect()
+        samples.append(collections.OrderedDict([
+            ('simulated', now.isoformat()),
+            ('frames', harness.frames),
+            ('wall_s', time.perf_counter() - started),
+            ('traced_kb', tracemalloc.get_traced_memory()[0] / 1024),
+            ('rss_kb', get_rss_kb())]))
+        print('{simulated} frames={frames} traced_kb={traced_kb:.0f} '
+              'rss_kb={rss_kb}'.format(**samples[-1]), file=sys.stderr)
+
+    now = harness.run_until(
+        args.start, args.start + datetime.timedelta(hours=args.warmup_hours))
+    baseline = take_snapshot()
+    sample(now)
+    baseline_sample = samples[-1]
+
+    while now < end:
+        now = harness.run_until(now, min(end, now + sample_interval))
+        sample(now)
+
+    snapshot = take_snapshot()
+    tracemalloc.stop()
+
+    traced_growth = sum(stat.size_diff for stat in
+                        snapshot.compare_to(baseline, 'filename')) / 1024
+    rss_growth = None
+    if samples[-1]['rss_kb'] is not None:
+        rss_growth = samples[-1]['rss_kb'] - baseline_sample['rss_kb']
+
+    failures = []
+    if traced_growth > args.max_traced_growth_kb:
+        failures.append('traced memory grew by {:.0f} kB'.format(
+            traced_growth))
+    if rss_growth is not None and rss_growth > args.max_rss_growth_kb:
+        failures.append('RSS grew by {} kB'.format(rss_growth))
+
+    return collections.OrderedDict([
+        ('commit', run.get_commit()),
+        ('python', platform.python_version()),
+        ('machine', platform.machine()),
+        ('days', args.days),
+        ('events_per_day', args.events_per_day),
+        ('frames', harness.frames),
+        ('traced_growth_kb', traced_growth),
+        ('rss_growth_kb', rss_growth),
+        ('passed', not failures),
+        ('failures', failures),
+        ('top_growth', get_top_growth(snapshot, baseline, args.top)),
+        ('samples', samples)])
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--days', type=int, default=7,
+                        help='simulated days to run for')
+    parser.add_argument('--start', default=datetime.datetime(2018, 1, 1),
+                        type=lambda s: datetime.datetime.strptime(s, '%Y-%m-%d'))
+    parser.add_argument('--step-seconds', type=int, default=60,
+                        help='simulated seconds between frames')
+    parser.add_argument('--events-per-day', type=int, default=20)
+    parser.add_argument('--all-day-fraction', type=float, default=0.1)
+    parser.add_argument('--sync-interval-minutes', type=int, default=2)
+    parser.add_argument('--changes-per-sync', type=int, default=1)
+    parser.add_argument('--sync-horizon-in-days', type=int, default=14)
+    parser.add_argument('--warmup-hours', type=int, default=24,
+                        help='simulated hours before the baseline is taken')
+    parser.add_argument('--sample-hours', type=int, default=6,
+                        help='simulated hours between memory samples')
+    parser.add_argument('--traceback-frames', type=int, default=1,
+                        help='frames recorded per allocation (more is slower)')
+    parser.add_argument('--max-traced-growth-kb', type=float, default=1024)
+    parser.add_argument('--max-rss-growth-kb', type=float, default=8192)
+    parser.add_argument('--top', type=int, default=10,
+                        help='number of growing allocation sites to report')
+    parser.add_argument('--output', default='-',
+                        help="file to write the report to ('-' for stdout)")
+    args = parser.parse_args()
+
+    report = soak(args)
+
+    if args.output == '-':
+        json.dump(report, sys.stdout, indent=1)
+        print()
+    else:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=1)
+
+    for failure in report['failures']:
+        print('FAILED: ' + failure, file=sys.stderr)
+
+    sys.exit(0 if report['passed'] else 1)
@@ -0,0 +1,226 @@
+import argparse
+import datetime
+import json
+import random
+
+import apiclient.errors
+import httplib2
+
+STRFTIME_FMT = '%Y-%m-%dT%H:%M:%SZ'
+
+# Durations (in minutes) that timed events are picked from.
+TIMED_DURATIONS = [15, 30, 30, 45, 60, 60, 60, 90, 120, 180, 480]
+
+# Durations (in days) that all-day events are picked from.
+ALL_DAY_DURATIONS = [1, 1, 1, 1, 2, 3, 7]
+
+
+def generate_events(count, start, days, all_day_fraction, seed=0,
+                    prefix='event'):
+    """
+    Generate Google Calendar event resources spread over a time frame.
+    :param count: The number of events.
+    :param start: The start of the time frame (a naive UTC datetime).
+    :param days: The length of the time frame in days.
+    :param all_day_fraction: The fraction of events that are all-day events.
+    :param seed: Seed for the random number generator, the same arguments
+    always give the same events.
+    :return: A list of event resources.
+    """
+    rng = random.Random(seed)
+    events = []
+
+    for i in range(count):
+        event = {'id': '{}{}'.format(prefix, i),
+                 'status': 'confirmed',
+                 'summary': 'Event {}'.format(i)}
+
+        if rng.random() < all_day_fraction:
+            day = start.date() + datetime.timedelta(days=rng.randrange(days))
+            length = datetime.timedelta(days=rng.choice(ALL_DAY_DURATIONS))
+            event['start'] = {'date': day.isoformat()}
+            event['end'] = {'date': (day + length).isoformat()}
+        else:
+            # Start on a quarter of an hour, like most real events.
+            begin = start + datetime.timedelta(
+                minutes=15 * rng.randrange(days * 24 * 4))
+            length = datetime.timedelta(minutes=rng.choice(TIMED_DURATIONS))
+            event['start'] = {'dateTime': begin.strftime(STRFTIME_FMT)}
+            event['end'] = {'dateTime': (begin + length).strftime(STRFTIME_FMT)}
+
+        events.append(event)
+
+    return events
+
+
+def generate_calendars(count, start, days, all_day_fraction, calendars=3,
+                       seed=0):
+    """
+    Generate events (see generate_events) split over a number of calendars.
+    :return: A dictionary mapping calendar ids to lists of event resources,
+    the format of the fixtures read by 'main.py --mode render'.
+    """
+    result = {}
+
+    for c in range(calendars):
+        calendar_id = 'calendar{}@example.com'.format(c)
+        share = count // calendars + (1 if c < count % calendars else 0)
+        result[calendar_id] = generate_events(
+            share, start, days, all_day_fraction, seed=seed + c,
+            prefix='c{}e'.format(c))
+
+    return result
+
+
+class StubRequest(object):
+    """ A request of StubService, executed locally. """
+
+    def __init__(self, fn, kwargs):
+        self._fn = fn
+        self._kwargs = kwargs
+
+    def execute(self):
+        return self._fn(**self._kwargs)
+
+
+class StubBatch(object):
+    """ A batch request of StubService. """
+
+    def __init__(self, service, callback):
+        self._service = service
+        self._callback = callback
+        self._requests = []
+
+    def add(self, request, request_id):
+        self._requests.append((request_id, request))
+
+    def execute(self):
+        self._service.round_trips += 1
+        for request_id, request in self._requests:
+            try:
+                response, exception = request.execute(), None
+            except apiclient.errors.HttpError as e:
+                response, exception = None, e
+            self._callback(request_id, response, exception)
+
+
+class StubEvents(object):
+    """ The events collection of StubService. """
+
+    def __init__(self, service):
+        self._service = service
+
+    def list(self, **kwargs):
+        return StubRequest(self._service.list_events, kwargs)
+
+
+class StubService(object):
+    """
+    Stands in for the Google Calendar API service object, serving the
+    events.list requests made by GoogleCalendarPlugin.get_events (including
+    paging, sync tokens and batches) from memory.
+    """
+
+    def __init__(self, calendars):
+        """
+        Constructs a StubService.
+        :param calendars: A dictionary mapping calendar ids to lists of event
+        resources.
+        """
+        self._events = dict((calendar_id, dict((e['id'], e) for e in events))
+                            for calendar_id, events in calendars.items())
+        # Changes made through change_event, per calendar. A sync token is
+        # the number of changes the client has seen, prefixed with the
+        # generation of tokens it belongs to.
+        self._changes = dict((calendar_id, []) for calendar_id in calendars)
+        self._generation = 0
+        # HTTP statuses that requests for a calendar fail with.
+        self._errors = {}
+        self.round_trips = 0
+
+    def calendars(self):
+        """ Return the calendars in the format of get_calendars. """
+        return [{'id': calendar_id, 'selected': True}
+                for calendar_id in sorted(self._events)]
+
+    def change_event(self, calendar_id, event):
+        """ Add, update or (if its status is 'cancelled') remove an event. """
+        self._changes[calendar_id].append(event)
+        if event.get('status') == 'cancelled':
+            self._events[calendar_id].pop(event['id'], None)
+        else:
+            self._events[calendar_id][event['id']] = event
+
+    def expire_sync_tokens(self):
+        """ Make requests with the sync tokens handed out so far fail (410). """
+        self._generation += 1
+
+    def set_error(self, calendar_id, status):
+        """ Make requests for a calendar fail with status (or succeed if None). """
+        if status is None:
+            self._errors.pop(calendar_id, None)
+        else:
+            self._errors[calendar_id] = status
+
+    def events(self):
+        return StubEvents(self)
+
+    def new_batch_http_request(self, callback):
+        return StubBatch(self, callback)
+
+    def list_events(self, calendarId, maxResults=250, pageToken=None,
+                    syncToken=None, **kwargs):
+        if calendarId not in self._events:
+            raise apiclient.errors.HttpError(
+                httplib2.Response({'status': 404}), b'Not Found')
+
+        if calendarId in self._errors:
+            raise apiclient.errors.HttpError(
+                httplib2.Response({'status': self._errors[calendarId]}),
+                b'Error')
+
+        changes = self._changes[calendarId]
+
+        if syncToken is not None:
+            generation, seen = syncToken.split(':')
+            if int(generation) != self._generation:
+                raise apiclient.errors.HttpError(
+                    httplib2.Response({'status': 410}), b'Gone')
+            items = changes[int(seen):]
+        else:
+            items = list(self._events[calendarId].values())
+
+        first = int(pageToken or 0)
+        result = {'items': items[first:first + maxResults]}
+
+        if first + maxResults < len(items):
+            result['nextPageToken'] = str(first + maxResults)
+        else:
+            result['nextSyncToken'] = '{}:{}'.format(self._generation,
+                                                     len(changes))
+
+        return result
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(
+        description='Write a synthetic calendar as a JSON fixture.')
+    parser.add_argument('--events', type=int, default=100)
+    parser.add_argument('--days', type=int, default=7)
+    parser.add_argument('--all-day-fraction', type=float, default=0.2)
+    parser.add_argument('--calendars', type=int, default=3)
+    parser.add_argument('--start', default=None,
+                        type=lambda s: datetime.datetime.strptime(s, '%Y-%m-%d'),
+                        help='first day of the events (default: today)')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', default='fixture.json')
+    args = parser.parse_args()
+
+    start = args.start or datetime.datetime.combine(
+        datetime.date.today(), datetime.time())
+
+    with open(args.output, 'w') as f:
+        json.dump(generate_calendars(args.events, start, args.days,
+                                     args.all_day_fraction, args.calendars,
+                                     args.seed), f, indent=1)
@@ -3,7 +3,44 @@ import collections
 #ArcParams = collections.namedtuple("ArcParams", ["centre", "radius",
 #    "start_angle", "end_angle"])
 
+Rectangle = collections.namedtuple("Rectangle", ["left", "top", "width",
+    "height"])
+
 import datetime
+import math
 
 def utc_to_local(utc):
-    return utc.replace(tzinfo=datetime.timezone.utc).astimezone(tz=None)
\ No newline at end of file
+    return utc.replace(tzinfo=datetime.timezone.utc).astimezone(tz=None)
+
+def expand_rectangle(rect, margin, width, height):
+    """
+    Grow rect by margin on every side, clipped to a width x height area.
+    """
+    left = max(0, int(rect.left) - margin)
+    top = max(0, int(rect.top) - margin)
+    right = min(width, int(rect.left + rect.width) + margin)
+    bottom = min(height, int(rect.top + rect.height) + margin)
+    return Rectangle(left, top, right - left, bottom - top)
+
+def bounding_rectangle(points, margin=0):
+    """
+    Return the smallest Rectangle with integer coordinates that contains all
+    points, grown by margin on every side.
+    """
+    xs = [p[0] for p in points]
+    ys = [p[1] for p in points]
+    left = int(math.floor(min(xs) - margin))
+    top = int(math.floor(min(ys) - margin))
+    right = int(math.ceil(max(xs) + margin))
+    bottom = int(math.ceil(max(ys) + margin))
+    return Rectangle(left, top, right - left, bottom - top)
+
+def intersect_rectangles(a, b):
+    """ Return the overlap of Rectangles a and b (or None if they don't). """
+    left = max(a.left, b.left)
+    top = max(a.top, b.top)
+    right = min(a.left + a.width, b.left + b.width)
+    bottom = min(a.top + a.height, b.top + b.height)
+    if right <= left or bottom <= top:
+        return None
+    return Rectangle(left, top, right - left, bottom - top)
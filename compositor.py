@@ -0,0 +1,163 @@
+import cairocffi as cairo
+
+import common
+import metrics
+
+# Time taken by each stage of a frame, with the layers' redraws labelled by
+# the layer's name.
+STAGE_SECONDS = metrics.REGISTRY.histogram(
+    'calendar_render_stage_seconds',
+    'Time taken by each stage of rendering a frame.')
+
+
+class Layer(object):
+    """
+    A component rendered into its own offscreen surface. The surface is only
+    redrawn when the layer is invalidated or when the value returned by
+    key_fn changes; otherwise the cached pixels are reused.
+    """
+
+    def __init__(self, name, bounding_box, render_fn, key_fn=None):
+        """
+        Constructs a Layer.
+        :param name: A name for the layer (used for debugging and metrics).
+        :param bounding_box: The area of the window the layer covers (an
+        object with left, top, width and height attributes).
+        :param render_fn: A callable taking a cairo context and the current
+        datetime that draws the layer using window coordinates. It may return
+        a list of Rectangles covering everything it drew, in which case only
+        those areas (and the areas drawn last time) are reported as damaged.
+        If it returns None the whole layer is assumed to have changed.
+        :param key_fn: A callable taking the current datetime and returning a
+        hashable value. The layer is redrawn whenever this value changes. If
+        None the layer is only drawn once (or when invalidated).
+        """
+        self._name = name
+        self._rect = common.Rectangle(int(bounding_box.left),
+                                      int(bounding_box.top),
+                                      int(bounding_box.width),
+                                      int(bounding_box.height))
+        self._render_fn = render_fn
+        self._key_fn = key_fn
+        self._key = None
+        self._valid = False
+        self._drawn = [self._rect]
+        self._surface = cairo.ImageSurface(cairo.FORMAT_ARGB32,
+                                           self._rect.width,
+                                           self._rect.height)
+        self._context = cairo.Context(self._surface)
+
+    def name(self):
+        return self._name
+
+    def invalidate(self):
+        """ Force the layer to be redrawn on the next update. """
+        self._valid = False
+        self._drawn = [self._rect]
+
+    def update(self, now):
+        """
+        Redraw the layer if it is out of date.
+        :return: A list of Rectangles (in window coordinates) that changed.
+        """
+        key = self._key_fn(now) if self._key_fn is not None else None
+
+        if self._valid and key == self._key:
+            return []
+
+        context = self._context
+
+        with STAGE_SECONDS.time(stage=self._name):
+            context.save()
+            context.set_operator(cairo.constants.OPERATOR_CLEAR)
+            context.paint()
+            context.restore()
+
+            context.save()
+            context.translate(-self._rect.left, -self._rect.top)
+            drawn = self._render_fn(context, now)
+            context.new_path()
+            context.restore()
+
+            self._surface.flush()
+        self._key = key
+        self._valid = True
+
+        if drawn is None:
+            drawn = [self._rect]
+
+        damage = self._drawn + drawn
+        self._drawn = drawn
+
+        return [r for r in (common.intersect_rectangles(r, self._rect)
+                            for r in damage) if r is not None]
+
+    def composite(self, context):
+        """ Paint the cached surface onto context. """
+        context.set_source_surface(self._surface, self._rect.left,
+                                   self._rect.top)
+        context.rectangle(*self._rect)
+        context.fill()
+
+
+class Compositor(object):
+    """ Composites a stack of cached layers on top of a solid background. """
+
+    def __init__(self, width, height, background_colour):
+        self._width = width
+        self._height = height
+        self._background_colour = background_colour
+        self._layers = []
+        # Whether the whole window has been painted since the compositor was
+        # created or invalidated (layers needn't cover all of it).
+        self._valid = False
+
+    def add_layer(self, layer):
+        """ Add a layer on top of all previously added layers. """
+        self._layers.append(layer)
+        return layer
+
+    def invalidate(self):
+        """ Force the whole window to be redrawn on the next update. """
+        self._valid = False
+        for layer in self._layers:
+            layer.invalidate()
+
+    def render(self, context, now):
+        """
+        Bring all layers up to date and composite the areas that changed
+        onto context.
+        :return: A list of Rectangles that changed (empty if nothing did).
+        """
+        damage = []
+        for layer in self._layers:
+            for rect in layer.update(now):
+                if rect not in damage:
+                    damage.append(rect)
+
+        if not self._valid:
+            damage = [common.Rectangle(0, 0, self._width, self._height)]
+            self._valid = True
+
+        if not damage:
+            return damage
+
+        context.save()
+
+        for rect in damage:
+            context.rectangle(*rect)
+        context.clip()
+
+        with STAGE_SECONDS.time(stage='background'):
+            context.set_operator(cairo.constants.OPERATOR_SOURCE)
+            context.set_source_rgba(*self._background_colour)
+            context.paint()
+
+        with STAGE_SECONDS.time(stage='composite'):
+            context.set_operator(cairo.constants.OPERATOR_OVER)
+            for layer in self._layers:
+                layer.composite(context)
+
+        context.restore()
+
+        return damage
@@ -71,6 +71,45 @@ cfg = dotmap.DotMap(
         'background_colour' : (0, 0, 0, 1)
     },
 
+    'framebuffer' :
+    {
+        # Used with '--display fbdev'. The depth is read from sysfs when the
+        # device is a real framebuffer.
+        'device' : '/dev/fb0',
+        'bits_per_pixel' : 32
+    },
+
+    'animation' :
+    {
+        # Sweep the hands and rotate the spiral continuously rather than
+        # updating once a minute.
+        'enabled' : False,
+        'fps' : 10,
+        # The fraction of each frame's time that drawing may typically take
+        # before less is animated: first only the hands, then nothing.
+        'budget' : 0.8,
+        # The number of frames the typical cost is measured over.
+        'window' : 30,
+        # How long to wait before animating more again.
+        'retry_interval_in_seconds' : 600
+    },
+
+    'metrics' :
+    {
+        # Render and sync metrics are published in the Prometheus text
+        # format to a file (e.g. for node_exporter's textfile collector)
+        # and/or over HTTP on a port on localhost. None disables either.
+        'textfile' : None,
+        'write_interval_in_seconds' : 15,
+        'port' : None
+    },
+
+    'text_cache' :
+    {
+        # Memory available for pre-rendered strings.
+        'max_bytes' : 2 * 1024 * 1024
+    },
+
     'palette' : PALETTE,
 
     'app_heading' :
@@ -90,7 +129,8 @@ cfg = dotmap.DotMap(
 
         'stroke' : None,
 
-        'text_fn' : lambda : datetime.datetime.now().strftime("  %A, %d{} of %B %Y").format(NR_SUFFIX[datetime.datetime.now().day%10]),
+        # Called with the local time of the frame.
+        'text_fn' : lambda now : now.strftime("  %A, %d{} of %B %Y").format(NR_SUFFIX[now.day%10]),
 
         'font' :
         {
@@ -182,6 +222,20 @@ cfg = dotmap.DotMap(
             'front_thickness_pc' : 0.01,
             'back_thickness_pc' : 0.02
         },
+
+        # Only drawn in animation mode.
+        'second_hand' :
+        {
+            'fill' :
+            {
+                'colour' : (1, 0.2, 0.2, 1)
+            },
+            'stroke' : None,
+            'front_depth_pc' : 0.48,
+            'back_depth_pc' : 0.08,
+            'front_thickness_pc' : 0.004,
+            'back_thickness_pc' : 0.008
+        },
     },
 
     'timeline' :
@@ -196,6 +250,18 @@ cfg = dotmap.DotMap(
 
         'thickness' : 15,
 
+        # Maximum distance (in pixels) between the drawn spiral and the true
+        # curve, this controls how finely the spiral is tessellated.
+        'max_pixel_error' : 0.25,
+
+        # Draw the events of plugins that support it in bulk from NumPy
+        # arrays rather than one at a time (worthwhile for large calendars).
+        'columnar_events' : False,
+
+        # How far (in pixels) a tap may miss an event on the spiral and
+        # still select it.
+        'hit_tolerance' : 10,
+
         'stroke_fn': lambda weekday: dotmap.DotMap(
         {
             'colour': PALETTE[weekday], # not used
@@ -443,6 +509,18 @@ cfg = dotmap.DotMap(
                 'font_face' : ("Deja Vu", cairo.FONT_SLANT_NORMAL, cairo.FONT_WEIGHT_NORMAL),
                 'height': 20
             }
+        },
+
+        # The event selected by tapping it on the spiral.
+        'selected_event':
+        {
+            'background' :
+            {
+                'fill' :
+                {
+                    'colour' : (1, 1, 1, 0.25)
+                }
+            }
         }
     },
 
@@ -456,7 +534,15 @@ cfg = dotmap.DotMap(
                 'client_secret_file' : './credentials/google-api/client_secret.json',
                 'saved_credentials_file' : './credentials/google-api/saved_credentials.json',
                 'application_name' : 'mxklabs-pi',
-                'update_frequency_in_seconds' : 120
+                # Events are kept here so they can be shown straight away on
+                # start-up and while offline (set to None to disable).
+                'event_store_file' : './cache/google-api/events.sqlite',
+                'update_frequency_in_seconds' : 120,
+                # Number of events per page when listing events (at most 2500).
+                'page_size' : 250,
+                # Events are synced for this many days ahead; only changes
+                # are requested until the display moves past that window.
+                'sync_horizon_in_days' : 14
             }
         }
     ]
@@ -0,0 +1,56 @@
+import datetime
+
+import numpy
+
+EPOCH = datetime.datetime(1970, 1, 1)
+
+
+def to_epoch_seconds(dt):
+    """ Convert a naive datetime to seconds since EPOCH. """
+    return (dt - EPOCH).total_seconds()
+
+
+class EventColumns(object):
+    """
+    The timeline items of a frame stored as one NumPy array per attribute
+    so that they can be mapped onto the spiral all at once. Items of plugins
+    that don't provide clockface styles are kept aside in fallback_events.
+    """
+
+    def __init__(self, events, plugins):
+        """
+        Constructs EventColumns.
+        :param events: A list of TimelineItems.
+        :param plugins: The list of plugins, the position of an item's plugin
+        in this list is its plugin id.
+        """
+        plugin_ids = dict((p, i) for i, p in enumerate(plugins))
+
+        starts = []
+        ends = []
+        style_ids = []
+        item_plugin_ids = []
+        # The items in the order of the arrays.
+        self.items = []
+        self.fallback_events = []
+
+        for event in events:
+            style_id = event.plugin().get_clockface_style_id(event)
+
+            if style_id is None:
+                self.fallback_events.append(event)
+                continue
+
+            starts.append(to_epoch_seconds(event.start()))
+            ends.append(to_epoch_seconds(event.end()))
+            style_ids.append(style_id)
+            item_plugin_ids.append(plugin_ids[event.plugin()])
+            self.items.append(event)
+
+        self.start = numpy.array(starts, dtype=float)
+        self.end = numpy.array(ends, dtype=float)
+        self.style_id = numpy.array(style_ids, dtype=int)
+        self.plugin_id = numpy.array(item_plugin_ids, dtype=int)
+
+    def __len__(self):
+        return len(self.start)
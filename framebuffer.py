@@ -0,0 +1,89 @@
+import mmap
+import os
+import stat
+
+import cairocffi as cairo
+
+# Cairo formats matching the pixel layout of a framebuffer with a given
+# number of bits per pixel.
+FORMATS = \
+{
+    16 : cairo.FORMAT_RGB16_565,
+    32 : cairo.FORMAT_RGB24
+}
+
+SYSFS_GRAPHICS = '/sys/class/graphics'
+
+
+class FrameBuffer(object):
+    """
+    Exposes a Linux framebuffer device as a cairo surface by mapping it into
+    memory, so frames are drawn straight into video memory with no further
+    copies. Any other file can be used in place of a device (which is
+    useful for testing), in which case it is laid out like a framebuffer of
+    the requested size and depth.
+    """
+
+    def __init__(self, path, width, height, bits_per_pixel=32):
+        """
+        Constructs a FrameBuffer.
+        :param path: A framebuffer device such as /dev/fb0 or a plain file.
+        :param width: The width of the surface in pixels.
+        :param height: The height of the surface in pixels.
+        :param bits_per_pixel: The depth of the framebuffer. This is read from
+        sysfs when path is a framebuffer device.
+        """
+        sysfs = os.path.join(SYSFS_GRAPHICS, os.path.basename(path))
+        stride = None
+
+        if os.path.isdir(sysfs):
+            bits_per_pixel = int(self.read_sysfs(sysfs, 'bits_per_pixel'))
+            stride = int(self.read_sysfs(sysfs, 'stride'))
+
+        if bits_per_pixel not in FORMATS:
+            raise ValueError("Unsupported framebuffer depth: {} bits per "
+                             "pixel".format(bits_per_pixel))
+
+        fmt = FORMATS[bits_per_pixel]
+
+        if stride is None:
+            stride = cairo.ImageSurface.format_stride_for_width(fmt, width)
+
+        size = stride * height
+
+        fd = os.open(path, os.O_RDWR | os.O_CREAT)
+        try:
+            if stat.S_ISREG(os.fstat(fd).st_mode) and \
+                    os.fstat(fd).st_size < size:
+                os.ftruncate(fd, size)
+
+            self._map = mmap.mmap(fd, size, mmap.MAP_SHARED,
+                                  mmap.PROT_READ | mmap.PROT_WRITE)
+        finally:
+            os.close(fd)
+
+        self.size = width, height
+        self.surface = cairo.ImageSurface.create_for_data(
+            self._map, fmt, width, height, stride)
+
+    @staticmethod
+    def read_sysfs(sysfs, attribute):
+        with open(os.path.join(sysfs, attribute)) as f:
+            return f.read().strip()
+
+    def present(self, damage):
+        """
+        Show a frame. Frames are rendered straight into the mapping so there
+        is nothing to copy.
+        """
+        pass
+
+    def close(self):
+        self.surface.finish()
+        self._map.flush()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
@@ -0,0 +1,147 @@
+import numpy
+
+
+class SegmentGrid(object):
+    """
+    A uniform grid over the line segments of polylines, for finding the
+    polyline drawn under a point (such as a tap on the touchscreen).
+
+    Polylines are added while a frame is drawn. On the first query every
+    segment is entered into each cell that its stroke, grown by the
+    tolerance, overlaps and the entries are sorted by cell. A query then
+    finds the point's cell with a binary search and only measures the
+    distance to the few segments in it.
+    """
+
+    def __init__(self, cell_size=16, tolerance=0):
+        """
+        Constructs a SegmentGrid.
+        :param cell_size: The size of a cell in pixels.
+        :param tolerance: How far (in pixels) a point may be outside of a
+        stroke and still hit it.
+        """
+        self._cell_size = cell_size
+        self._tolerance = tolerance
+        self._items = []
+        # Arrays of segment ends, half line widths and item indices, one of
+        # each per call to add_polylines.
+        self._starts = []
+        self._ends = []
+        self._half_widths = []
+        self._item_indices = []
+        self._index = None
+
+    def __len__(self):
+        return sum(len(starts) for starts in self._starts)
+
+    def add_polylines(self, points, offsets, items, line_width):
+        """
+        Add many polylines, in the format of SpiralGeometry.slices_flat.
+        :param points: An (n, 2) array with the points of all polylines.
+        :param offsets: An array with the index one past the last point of
+        each polyline.
+        :param items: The item that each polyline belongs to (returned by
+        query).
+        :param line_width: The width of the polylines' strokes.
+        """
+        points = numpy.asarray(points, dtype=float)
+        offsets = numpy.asarray(offsets, dtype=int)
+
+        if len(points) < 2:
+            return
+
+        # A segment joins each point to the next one, except where the next
+        # point starts another polyline.
+        segment = numpy.ones(len(points) - 1, dtype=bool)
+        segment[offsets[:-1] - 1] = False
+        first = numpy.flatnonzero(segment)
+
+        self._starts.append(points[first])
+        self._ends.append(points[first + 1])
+        self._half_widths.append(numpy.full(len(first), line_width / 2.0))
+        self._item_indices.append(len(self._items) + numpy.searchsorted(
+            offsets, first, side='right'))
+        self._items.extend(items)
+        self._index = None
+
+    def add_polyline(self, points, item, line_width):
+        """ Add a single polyline (a sequence of points). """
+        self.add_polylines(points, [len(points)], [item], line_width)
+
+    def build(self):
+        """ Sort the segments into the grid's cells. """
+        if not self._starts:
+            self._index = ()
+            return
+
+        starts = numpy.concatenate(self._starts)
+        ends = numpy.concatenate(self._ends)
+        half_widths = numpy.concatenate(self._half_widths)
+        item_indices = numpy.concatenate(self._item_indices)
+
+        reach = (half_widths + self._tolerance)[:, None]
+        low = numpy.floor((numpy.minimum(starts, ends) - reach) /
+                          self._cell_size).astype(numpy.int64)
+        high = numpy.floor((numpy.maximum(starts, ends) + reach) /
+                           self._cell_size).astype(numpy.int64)
+
+        origin = low.min(axis=0)
+        low -= origin
+        high -= origin
+        rows = high[:, 1].max() + 1
+
+        # Enumerate the cells that each segment's bounding box covers.
+        sizes = high - low + 1
+        counts = sizes[:, 0] * sizes[:, 1]
+        segments = numpy.repeat(numpy.arange(len(starts)), counts)
+        index = numpy.arange(counts.sum()) - numpy.repeat(
+            numpy.cumsum(counts) - counts, counts)
+        cell_x = low[segments, 0] + index // sizes[segments, 1]
+        cell_y = low[segments, 1] + index % sizes[segments, 1]
+        cells = cell_x * rows + cell_y
+
+        order = numpy.argsort(cells, kind='stable')
+        self._index = (origin, rows, high.max(axis=0), cells[order],
+                       segments[order], starts, ends, half_widths,
+                       item_indices)
+
+    def query(self, x, y):
+        """
+        Return the item whose stroke passes closest to (x, y), or None if no
+        stroke is within the tolerance.
+        """
+        if self._index is None:
+            self.build()
+        if not self._index:
+            return None
+
+        origin, rows, limit, cells, segments, starts, ends, half_widths, \
+            item_indices = self._index
+
+        cell = numpy.floor(numpy.array([x, y]) / self._cell_size) \
+            .astype(numpy.int64) - origin
+        if (cell < 0).any() or (cell > limit).any():
+            return None
+
+        cell_id = cell[0] * rows + cell[1]
+        candidates = segments[numpy.searchsorted(cells, cell_id, side='left'):
+                              numpy.searchsorted(cells, cell_id, side='right')]
+        if len(candidates) == 0:
+            return None
+
+        # The distance from the point to each candidate segment.
+        a = starts[candidates]
+        ab = ends[candidates] - a
+        ap = numpy.array([x, y]) - a
+        length_squared = (ab * ab).sum(axis=1)
+        u = numpy.clip((ap * ab).sum(axis=1) /
+                       numpy.maximum(length_squared, 1e-12), 0, 1)
+        offset = ap - u[:, None] * ab
+        distance = numpy.sqrt((offset * offset).sum(axis=1)) - \
+            half_widths[candidates]
+
+        nearest = numpy.argmin(distance)
+        if distance[nearest] > self._tolerance:
+            return None
+
+        return self._items[item_indices[candidates[nearest]]]
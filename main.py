@@ -1,22 +1,53 @@
 import argparse
 import collections
 import datetime
+import json
 import math
 import os
 import time
-import tkinter
 
 import cairocffi as cairo
-import PIL.Image
-import PIL.ImageTk
+import numpy
 
 from config import cfg
+from compositor import Compositor, Layer, STAGE_SECONDS
+from framebuffer import FrameBuffer
+from renderconfig import compile_config
+from scheduler import FramePacer, FrameScheduler, MINUTE_TICKS, ANIMATE_HANDS, ANIMATE_ALL
+from tessellation import SpiralGeometry, SpiralTessellator
+from textcache import TextSpriteCache
 
 import common
+import eventcolumns
+import hitindex
+import metrics
 import plugins.plugin
 
+FRAME_SECONDS = metrics.REGISTRY.histogram(
+    'calendar_frame_seconds',
+    'Time taken to collect events for, render and present a frame.')
+
+FRAMES_RENDERED = metrics.REGISTRY.counter(
+    'calendar_frames_rendered_total',
+    'Frames in which something changed and was drawn.')
+
+FRAMES_SKIPPED = metrics.REGISTRY.counter(
+    'calendar_frames_skipped_total',
+    'Frames in which nothing had changed so nothing was drawn.')
+
+FRAMES_DROPPED = metrics.REGISTRY.counter(
+    'calendar_frames_dropped_total',
+    'Animation frames dropped because the previous frame took too long.')
+
+ANIMATION_DETAIL = metrics.REGISTRY.gauge(
+    'calendar_animation_detail',
+    'What is animated: 0 nothing (minute ticks), 1 the hands, 2 everything.')
+
 class CairoUtils(object):
 
+    # A TextSpriteCache used by draw_text (if set).
+    text_cache = None
+
     @staticmethod
     def set_fill_params(context, fill_params):
         """ Set context to fill_params. """
@@ -24,11 +55,17 @@ class CairoUtils(object):
 
     @staticmethod
     def draw_text(context, text, text_location, text_params, angle=0, centre_x=-1, centre_y=-1):
-        context.set_source_rgba(*text_params.colour)
-        context.set_font_size(text_params.font_size)
-        font_face = context.select_font_face(*text_params.font_face)
-        context.set_font_face(font_face)
-        _, _, w, h, _, _ = context.text_extents(text)
+
+        if CairoUtils.text_cache is not None:
+            sprite = CairoUtils.text_cache.get(text, text_params)
+            _, _, w, h, _, _ = sprite.extents
+        else:
+            sprite = None
+            context.set_source_rgba(*text_params.colour)
+            context.set_font_size(text_params.font_size)
+            font_face = context.select_font_face(*text_params.font_face)
+            context.set_font_face(font_face)
+            _, _, w, h, _, _ = context.text_extents(text)
 
         with ContextRestorer(context):
 
@@ -49,8 +86,19 @@ class CairoUtils(object):
             context.translate(*text_location)
             context.rotate(angle)
             context.translate(additional_x, additional_y)
-            context.move_to(0, 0)
-            context.show_text(text)
+
+            if sprite is not None:
+                # Blit the pre-rendered text with its origin at (0, 0),
+                # moving the sprite to whole device pixels so that its
+                # glyphs aren't resampled (and blurred).
+                x, y = context.user_to_device(-sprite.x_origin,
+                                              -sprite.y_origin)
+                context.set_source_surface(
+                    sprite.surface, *context.device_to_user(round(x), round(y)))
+                context.paint()
+            else:
+                context.move_to(0, 0)
+                context.show_text(text)
 
     @staticmethod
     def set_stroke_params(context, stroke_params):
@@ -80,6 +128,42 @@ class CairoUtils(object):
         for point in points:
             context.line_to(*point)
 
+    @staticmethod
+    def append_dots(context, points):
+        """
+        Append a closed subpath of a single point for each point, which a
+        stroke with round caps draws as a dot.
+        """
+        for point in points:
+            context.move_to(*point)
+            context.close_path()
+
+    @staticmethod
+    def set_end_cap_params(context, style):
+        """ Set context to draw the end caps of a ClockfaceStyle. """
+        context.set_source_rgba(*style.colour)
+        context.set_line_width(style.end_cap_width)
+        context.set_dash([], 0)
+        context.set_line_cap(cairo.constants.LINE_CAP_ROUND)
+
+    @staticmethod
+    def append_polylines(context, points, offsets):
+        """
+        Append many polylines to the context's path in one call.
+        :param points: An (n, 2) array with the points of all polylines.
+        :param offsets: An array with the index one past the last point of
+        each polyline.
+        """
+        if len(points) == 0:
+            return
+
+        # Each polyline starts with a MOVE_TO and carries on with LINE_TOs.
+        operations = [cairo.constants.PATH_LINE_TO] * len(points)
+        for start in numpy.append(0, offsets[:-1]).tolist():
+            operations[start] = cairo.constants.PATH_MOVE_TO
+
+        context.append_path(zip(operations, points.tolist()))
+
     @staticmethod
     def line_to_rounded_rect(context, left, top, width, height, arc_radius, open_left=False, open_right=False):
 
@@ -152,8 +236,8 @@ class AppHeading(object):
         self._config = config
         self._bb = self._config.bounding_box
 
-    def render(self, context, start_utc):
-        text = self._config.text_fn()
+    def render(self, context, now):
+        text = self._config.text_fn(now)
         #context.set_source_rgba(*self._config.background)
         context.rectangle(float(self._bb.left), float(self._bb.top), float(self._bb.width), float(self._bb.height))
         CairoUtils.draw(context, self._config)
@@ -177,6 +261,11 @@ class Clock(object):
         self._unit = self._bb.width
 
     def render(self, context, now):
+        self.render_face(context)
+        self.render_hands(context, now)
+
+    def render_face(self, context):
+        """ Draw the parts of the clock that never change. """
 
         with ContextRestorer(context):
 
@@ -199,11 +288,33 @@ class Clock(object):
 
                 self.draw_tick(context, i, 60, tick_params)
 
+    def render_hands(self, context, now, second_hand=False):
+        """
+        Draw the hour and minute hands (and optionally the second hand) for
+        now. The hands move continuously, so now should be rounded down to
+        the minute for hands that tick once a minute.
+        :return: A list of Rectangles covering the hands.
+        """
+        seconds = now.second + now.microsecond / 1e6
+
+        with ContextRestorer(context):
+
+            # Translate to middle of clock face.
+            context.translate(
+                self._bb.left + self._bb.width / 2,
+                self._bb.top + self._bb.height / 2)
+
             # Draw hour hand.
-            self.draw_hand(context, now.hour * 60 + now.minute, 12 * 60, self._config.hour_hand)
+            rects = [self.draw_hand(context, (now.hour * 60 + now.minute) * 60 + seconds, 12 * 60 * 60, self._config.hour_hand)]
 
             # Draw minute hand.
-            self.draw_hand(context, now.minute, 60, self._config.minute_hand)
+            rects.append(self.draw_hand(context, now.minute * 60 + seconds, 60 * 60, self._config.minute_hand))
+
+            # Draw second hand.
+            if second_hand:
+                rects.append(self.draw_hand(context, seconds, 60, self._config.second_hand))
+
+        return rects
 
     def draw_tick(self, context, num, den, params):
 
@@ -219,9 +330,14 @@ class Clock(object):
             CairoUtils.draw(context, params)
 
     def draw_hand(self, context, num, den, params):
+        """
+        Draw a hand rotated by num/den of a full turn.
+        :return: A Rectangle (in window coordinates) covering the hand.
+        """
+
+        rotation = (2 * math.pi) * (num / den)
 
         with ContextRestorer(context):
-            rotation = (2 * math.pi) * (num / den)
             context.rotate(rotation)
 
             p1 = (-(self._unit * params.back_thickness_pc) / 2,
@@ -241,6 +357,18 @@ class Clock(object):
 
             CairoUtils.draw(context, params)
 
+        centre_x = self._bb.left + self._bb.width / 2
+        centre_y = self._bb.top + self._bb.height / 2
+        cos_r = math.cos(rotation)
+        sin_r = math.sin(rotation)
+        corners = [(centre_x + x * cos_r - y * sin_r,
+                    centre_y + x * sin_r + y * cos_r)
+                   for x, y in (p1, p2, p3, p4)]
+
+        # Leave room for the stroke and antialiasing.
+        line_width = params.stroke.line_width if params.stroke else 0
+        return common.bounding_rectangle(corners, margin=line_width + 1)
+
 class Timeline(object):
 
     def __init__(self, config, plugins):
@@ -250,13 +378,25 @@ class Timeline(object):
         self._unit = self._bb.width
         self._centre = (self._bb.left + self._bb.width / 2,
                         self._bb.top + self._bb.height / 2)
+        self._geometry = None
+        self._geometry_key = None
         self._events = None
+        self._columns = None
+        # The strokes of the events drawn last (see hit_test), in the
+        # spiral's own frame, and the rotation onto the clock face.
+        self._hit_grid = None
+        self._hit_angle = 0
 
     def set_timeline_events(self, events):
         self._events = events
 
+        if self._config.columnar_events:
+            self._columns = eventcolumns.EventColumns(events, self._plugins)
+
     def datetime_to_t(self, datetime):
-        return 2 * math.pi * (datetime.hour * 60 + datetime.minute) / (12 * 60)
+        seconds = (datetime.hour * 60 + datetime.minute) * 60 + \
+            datetime.second + datetime.microsecond / 1e6
+        return 2 * math.pi * seconds / (12 * 60 * 60)
 
     def timedelta_to_t(self, timedelta):
         return 2*math.pi*timedelta.total_seconds() / (12 * 60 * 60)
@@ -267,11 +407,12 @@ class Timeline(object):
             x = (a * t + b) * math.sin(c * t + d)
             y = (a * t + b) * math.cos(c * t + d)
         where t=0 is closest to the edge of the clock face and every increment
-        of 2*math.pi corresponds to one rotation of the clock face.
+        of 2*math.pi corresponds to one rotation of the clock face. If now is
+        None the spiral has no phase (see get_geometry).
         """
         thickness = self._config.thickness
 
-        start_angle = self.datetime_to_t(now)
+        start_angle = self.datetime_to_t(now) if now is not None else 0
         max_radius = (self._unit / 2) - offset
 
         # Parameter 'a' corresponds to minus one 'thickness' per rotation.
@@ -294,21 +435,29 @@ class Timeline(object):
         t = self.timedelta_to_t(td)
         return self.get_spiral_point(spiral_params, t)
 
-    def get_spiral_points(self, spiral_params, t_min, t_max):
-        result = []
-        t = t_min
-        while t < t_max:
-            point = self.get_spiral_point(spiral_params, t)
-            result.append(point)
-            t += 0.1
+    def get_geometry(self, start_utc, end_utc):
+        """
+        Return the tessellated spiral for the timespan. As time passes the
+        spiral only rotates around its centre so the geometry is kept in the
+        spiral's own frame (see rotate_to_clockface) and is only rebuilt when
+        the timespan or the shape of the spiral changes.
+        """
+        t_max = self.timedelta_to_t(end_utc - start_utc)
+        key = (t_max, self._config.thickness, self._config.max_pixel_error)
 
-        point = self.get_spiral_point(spiral_params, t_max)
-        result.append(point)
+        if key != self._geometry_key:
+            tessellator = SpiralTessellator(
+                (0, 0), max_pixel_error=self._config.max_pixel_error)
+            self._geometry = SpiralGeometry(
+                tessellator, self.get_spiral_params(offset=0, now=None), t_max)
+            self._geometry_key = key
 
-        if len(result) == 1:
-            result.append(result[0])
+        return self._geometry
 
-        return result
+    def rotate_to_clockface(self, context, now):
+        """ Map the spiral's own frame onto the clock face at time now. """
+        context.translate(*self._centre)
+        context.rotate(self.datetime_to_t(now))
 
     def get_dt_control_points(self, start_utc, end_utc, hours):
         """
@@ -336,52 +485,33 @@ class Timeline(object):
 
     def render(self, context, start_utc, end_utc):
 
-        thickness = self._config.thickness
-        length = self._config.length
-
         t_min = 0
         t_max = ((end_utc - start_utc).total_seconds() / (12 * 60 * 60)) * 2 * math.pi + 4 * math.pi
 
         #print("t_min={}".format(t_min))
         #print("t_max={}".format(t_max))
-        spiral_params = self.get_spiral_params(offset=0, now=start_utc)
-
-        '''
-        
-        CairoUtils.set_stroke_params(context, self._config.primary_stroke)
-
-
-        t_to = self.timedelta_to_t(end_utc - start_utc)
-        separator_spiral_points = self.get_spiral_points(spiral_params, 0, t_to )
-        CairoUtils.line_to_points(context, separator_spiral_points)
-
-        context.stroke()
-
-        '''
-
-        end_utc_plus = end_utc + datetime.timedelta(hours=24)
 
         control_points = self.get_dt_control_points(start_utc, end_utc, hours=24)
         control_points_ex = [start_utc] + control_points + [end_utc]
 
-        for i in range(len(control_points_ex)-1):
+        t_from = [self.timedelta_to_t(dt - start_utc) for dt in control_points_ex[:-1]]
+        t_to = [self.timedelta_to_t(dt - start_utc) for dt in control_points_ex[1:]]
 
-            dt_from = control_points_ex[i]
-            dt_to = control_points_ex[i + 1]
+        # Cut all day segments out of the cached spiral in one go.
+        segments = self.get_geometry(start_utc, end_utc).slices(t_from, t_to)
 
-            t_from = self.timedelta_to_t(dt_from - start_utc)
-            t_to = self.timedelta_to_t(dt_to - start_utc)
+        with ContextRestorer(context):
 
-            weekday = datetime.datetime.strftime(dt_from, "%A").lower()
+            self.rotate_to_clockface(context, start_utc)
 
-            separator_spiral_points = self.get_spiral_points(spiral_params, t_from, t_to)
-            CairoUtils.line_to_points(context, separator_spiral_points)
-            stroke_params = self._config.stroke_fn(weekday)
-            print(stroke_params)
-            CairoUtils.set_stroke_params(context, stroke_params)
-            context.stroke()
-            
+            for dt_from, separator_spiral_points in zip(control_points_ex, segments):
+
+                weekday = datetime.datetime.strftime(dt_from, "%A").lower()
 
+                CairoUtils.line_to_points(context, separator_spiral_points.tolist())
+                stroke_params = self._config.weekdays[weekday].stroke
+                CairoUtils.set_stroke_params(context, stroke_params)
+                context.stroke()
 
     def render_day_label(self, context, location, weekday, open_left, open_right):
 
@@ -399,15 +529,15 @@ class Timeline(object):
                                             day_label_radius,
                                             open_left,
                                             open_right)
-            CairoUtils.draw(context, self._config.day_labels[weekday].background)
+            CairoUtils.draw(context, self._config.weekdays[weekday].label_background)
 
             text = weekday[0:3].upper()
 
             CairoUtils.draw_text(context=context,
                                  text=text,
                                  text_location=location,
-                                 text_params=self._config.day_labels[
-                                     weekday].font,
+                                 text_params=self._config.weekdays[
+                                     weekday].label_font,
                                  angle=0 * math.pi,
                                  centre_x=0,
                                  centre_y=0)
@@ -433,8 +563,8 @@ class Timeline(object):
                     weekday_start = datetime.datetime.strftime(midnight, "%A").lower()
                     weekday_end = datetime.datetime.strftime(midnight + datetime.timedelta(minutes=-1), "%A").lower()
 
-                    render_label(weekday_start, self._config.day_labels['day_start_label'])
-                    render_label(weekday_end, self._config.day_labels['day_end_label'])
+                    render_label(weekday_start, self._config.day_labels.day_start_label)
+                    render_label(weekday_end, self._config.day_labels.day_end_label)
 
 
         """
@@ -489,190 +619,710 @@ class Timeline(object):
         """
 
     def render_plugin_events(self, context, start_utc, end_utc):
+        """
+        Render the events of all plugins. The context is set up in the
+        spiral's own frame (see rotate_to_clockface). Events of plugins that
+        provide clockface styles are drawn in bulk from self._columns when
+        columnar_events is enabled, all other events are handed to their
+        plugin's render_on_clockface.
+        """
 
-        thickness = self._config.thickness
-        spiral_params = self.get_spiral_params(offset=0, now=start_utc)
+        geometry = self.get_geometry(start_utc, end_utc)
+
+        self._hit_grid = hitindex.SegmentGrid(
+            tolerance=self._config.hit_tolerance)
+        self._hit_angle = self.datetime_to_t(start_utc)
 
         context.set_source_rgba(1, 0, 0, 1)
         context.stroke()
 
-        for p in self._plugins: \
+        if self._columns is not None:
+            events = self._columns.fallback_events
+        else:
+            events = self._events
 
-            assert (isinstance(p, plugins.plugin.Plugin))
+        with ContextRestorer(context):
+
+            self.rotate_to_clockface(context, start_utc)
+
+            if self._columns is not None:
+                self.render_event_columns(context, start_utc, end_utc, geometry)
+
+            self.render_events_with_plugins(context, start_utc, end_utc,
+                                            geometry, events)
+
+    def render_event_columns(self, context, start_utc, end_utc, geometry):
+        """
+        Draw all events in self._columns with one path and one stroke per
+        plugin style, mapping their times onto the spiral with array
+        operations.
+        """
+        columns = self._columns
+
+        start_s = eventcolumns.to_epoch_seconds(start_utc)
+        end_s = eventcolumns.to_epoch_seconds(end_utc)
+        t_per_second = self.timedelta_to_t(datetime.timedelta(seconds=1))
+
+        t_from = (numpy.maximum(columns.start, start_s) - start_s) * t_per_second
+        t_to = (numpy.minimum(columns.end, end_s) - start_s) * t_per_second
+        visible = t_to >= t_from
+
+        for plugin_id, p in enumerate(self._plugins):
+
+            styles = p.get_clockface_styles()
+            if not styles:
+                continue
+
+            for style_id, style in enumerate(styles):
+
+                mask = visible & (columns.plugin_id == plugin_id) & \
+                    (columns.style_id == style_id)
 
-            plugin_spiral_params = self.get_spiral_params(offset=0, now=start_utc)
+                if not mask.any():
+                    continue
 
-            def spiral_point_generator(datetime):
-                point_timedelta = datetime - start_utc
-                point_t = self.timedelta_to_t(point_timedelta)
+                points, offsets = geometry.slices_flat(t_from[mask], t_to[mask])
+                CairoUtils.append_polylines(context, points, offsets)
+                CairoUtils.set_stroke_params(context, style)
+                context.stroke()
 
-                return self.get_spiral_point(plugin_spiral_params, point_t)
+                # Dots at the (unclipped) start and end of each item, like
+                # plugins draw them in render_on_clockface.
+                if style.end_cap_width is not None:
+                    ends = numpy.concatenate(
+                        [columns.start[mask], columns.end[mask]])
+                    CairoUtils.append_dots(
+                        context, geometry.get_points(
+                            (ends - start_s) * t_per_second).tolist())
+                    CairoUtils.set_end_cap_params(context, style)
+                    context.stroke()
 
-            def spiral_points_generator(datetime_from, datetime_to):
+                self._hit_grid.add_polylines(
+                    points, offsets,
+                    [columns.items[i] for i in numpy.flatnonzero(mask)],
+                    style.line_width)
+
+    def render_events_with_plugins(self, context, start_utc, end_utc,
+                                   geometry, events):
+        """
+        Let each plugin render its events. The point generators handed to
+        plugins return points in the spiral's own frame.
+        """
+
+        # Cut the visible part of every event out of the cached spiral up
+        # front so that the line generator handed to plugins is just a lookup.
+        ranges = [(max(start_utc, event.start()), min(end_utc, event.end()))
+                  for event in events]
+        segments = geometry.slices(
+            [self.timedelta_to_t(dt_from - start_utc) for dt_from, _ in ranges],
+            [self.timedelta_to_t(dt_to - start_utc) for _, dt_to in ranges])
+        event_points = dict(zip(ranges, segments))
+
+        for event, points in zip(events, segments):
+            self._hit_grid.add_polyline(points, event,
+                                        self.get_line_width(event))
+
+        def spiral_point_generator(datetime):
+            point_timedelta = datetime - start_utc
+            point_t = self.timedelta_to_t(point_timedelta)
+
+            return tuple(geometry.get_points([point_t])[0])
+
+        def spiral_points_generator(datetime_from, datetime_to):
+            points = event_points.get((datetime_from, datetime_to))
+
+            if points is None:
                 from_timedelta = datetime_from - start_utc
                 from_t = self.timedelta_to_t(from_timedelta)
                 to_timedelta = datetime_to - start_utc
                 to_t = self.timedelta_to_t(to_timedelta)
+                points = geometry.slices([from_t], [to_t])[0]
 
-                return self.get_spiral_points(plugin_spiral_params, from_t, to_t)
+            return points.tolist()
+
+        for p in self._plugins:
 
-            for event in self._events:
+            assert (isinstance(p, plugins.plugin.Plugin))
+
+            for event in events:
                 assert (isinstance(event, plugins.plugin.TimelineItem))
                 if event.plugin() == p:
                     p.render_on_clockface(context, start_utc, end_utc, event,
                                           spiral_point_generator,
                                           spiral_points_generator)
 
+    def get_line_width(self, event):
+        """
+        Return the width that an event is drawn with, as far as it is known
+        (plugins without clockface styles draw events however they like).
+        """
+        styles = event.plugin().get_clockface_styles()
+        style_id = event.plugin().get_clockface_style_id(event)
+
+        if not styles or style_id is None:
+            return 0
+        return styles[style_id].line_width
+
+    def hit_test(self, x, y):
+        """
+        Return the event drawn at window coordinates (x, y) by the last call
+        to render_plugin_events, or None.
+        """
+        if self._hit_grid is None:
+            return None
+
+        # Undo rotate_to_clockface.
+        dx = x - self._centre[0]
+        dy = y - self._centre[1]
+        cos = math.cos(self._hit_angle)
+        sin = math.sin(self._hit_angle)
+
+        return self._hit_grid.query(cos * dx + sin * dy, cos * dy - sin * dx)
+
 
 class EventList(object):
 
     def __init__(self, config):
         self._config = config
         self._events = None
+        self._selected_event = None
 
-    def datetime_to_heading(self, dt_utc):
+    def datetime_to_heading(self, dt_utc, now):
         """
         Workout what to display as a heading for a given datetime object with
         a UTC timezone. We basically translate the datetime to local time and
         if it matches today's date, we call 'today_header_text_fn', for tomorrow's
         date we call 'tomorrow_header_text_fn' and otherwise we call
         'datetime_header_text_fn' with the event's date.
+        :param now: The local time of the frame being rendered.
         """
-        now_utc = datetime.datetime.utcnow()
-        now_local = common.utc_to_local(now_utc)
-        tomorrow_local = common.utc_to_local(now_utc + datetime.timedelta(days=1))
+        today_local = now.date()
+        tomorrow_local = today_local + datetime.timedelta(days=1)
         dt_local = common.utc_to_local(dt_utc)
 
-        if now_local.year == dt_local.year and \
-                now_local.month == dt_local.month and \
-                now_local.day == dt_local.day:
+        if dt_local.date() == today_local:
             return self._config.today_header_text_fn()
-        elif tomorrow_local.year == dt_local.year and \
-                tomorrow_local.month == dt_local.month and \
-                tomorrow_local.day == dt_local.day:
+        elif dt_local.date() == tomorrow_local:
             return self._config.tomorrow_header_text_fn()
         else:
             return self._config.datetime_header_text_fn(dt_local)
 
-    def render(self, context):
-
+    def render(self, context, now):
 
-        text_location = (self._config.bounding_box.left, self._config.bounding_box.top)
+        bb = self._config.bounding_box
+        top = bb.top
 
+        def draw_line(text, font):
+            # Each line is font.height high with its baseline one font size
+            # below its top.
+            CairoUtils.draw_text(context, text,
+                                 (bb.left, top + font.font_size), font)
+            return top + font.height
 
         day = None
 
         for event in self._events:
             event_day = event.start().replace(hour=0, minute=0, second=0, microsecond=0)
 
-
-
             if event_day != day:
-                text = self.datetime_to_heading(event.start())
-                CairoUtils.draw_text(context, text,
-                                     text_location, self._config.heading.font)
+                top = draw_line(self.datetime_to_heading(event.start(), now),
+                                self._config.heading_font)
                 day = event_day
 
+            if (event.plugin(), event.id()) == self._selected_event:
+                with ContextRestorer(context):
+                    context.rectangle(bb.left, top, bb.width,
+                                      self._config.event_font.height)
+                    CairoUtils.draw(context, self._config.selected_event)
 
-            CairoUtils.draw_text(context,
-                                 event.title(),
-                                 text_location,
-                                 self._config.event.font)
-
+            top = draw_line(event.title(), self._config.event_font)
 
     def set_timeline_events(self, events):
         self._events = events
 
+    def set_selected_event(self, key):
+        """
+        Highlight an event.
+        :param key: A tuple (plugin, id) identifying the event, or None.
+        """
+        self._selected_event = key
 
-class MainWindow(tkinter.Tk):
-
-    def __init__(self, config, debug, *args, **kwargs):
-        super().__init__(*args, **kwargs)
 
-        self._config = config
+class Renderer(object):
+    """
+    Renders all components onto a cairo surface. The surface is supplied by
+    the display so it can live wherever the display needs the pixels to be.
+    """
 
-        if not debug:
-            super().attributes("-fullscreen", True)
-            super().config(cursor="none")
+    # Extra room around a component's bounding box for strokes, labels and
+    # text that are drawn slightly outside of it.
+    LAYER_MARGIN = 30
 
+    def __init__(self, config, plugins, surface):
+        # Compile the configuration so the render path only reads plain
+        # immutable records.
+        self._config = compile_config(config)
+        self._plugins = plugins
 
-        self.size = config.window.width, config.window.height
-        self.geometry("{}x{}".format(*self.size))
-        self.surface = cairo.ImageSurface(cairo.FORMAT_ARGB32, *self.size)
+        self.size = self._config.window.width, self._config.window.height
+        self.surface = surface
         self.context = cairo.Context(self.surface)
 
-        self._plugins = [plugin.plugin(plugin.config) for plugin in
-                         config.plugins]
+        CairoUtils.text_cache = TextSpriteCache(self._config.text_cache_max_bytes)
+
         self._timeline = Timeline(self._config.timeline, self._plugins)
-        self._event_list = EventList(config.event_list)
+        self._event_list = EventList(self._config.event_list)
         self._app_heading = AppHeading(self._config.app_heading)
         self._clock = Clock(self._config.clock)
 
-        self.label = tkinter.Label(self)
+        self._events_key = None
+        self._events_version = 0
+        self._selected_event = None
+        self._detail = MINUTE_TICKS
+        self._compositor = self.create_compositor()
+
+    def set_detail(self, detail):
+        """
+        Set how much is animated (see scheduler.FramePacer): with
+        MINUTE_TICKS every frame shows the time rounded down to the minute,
+        with ANIMATE_HANDS the hands move continuously and with ANIMATE_ALL
+        the spiral and the events do too.
+        """
+        self._detail = detail
+
+    def create_compositor(self):
+        """
+        Build the layer stack. Each layer is only redrawn when its key
+        changes: the clock face never, the heading once a day, the hands and
+        spiral once a minute (or every frame, see set_detail) and the event
+        layers when plugin data changes.
+        """
+        compositor = Compositor(self.size[0], self.size[1],
+                                self._config.window.background_colour)
+
+        def layer_bb(bb):
+            return common.expand_rectangle(bb, self.LAYER_MARGIN, *self.size)
+
+        def minute_key(now):
+            return now.replace(second=0, microsecond=0)
+
+        def spiral_time(now):
+            return now if self._detail == ANIMATE_ALL else minute_key(now)
+
+        def hands_time(now):
+            return now if self._detail >= ANIMATE_HANDS else minute_key(now)
+
+        def events_key(now):
+            return (self._events_version, spiral_time(now))
+
+        timeline_bb = layer_bb(self._config.timeline.bounding_box)
+        clock_bb = layer_bb(self._config.clock.bounding_box)
+
+        compositor.add_layer(Layer(
+            'timeline', timeline_bb,
+            lambda context, now: self._timeline.render(
+                context, spiral_time(now),
+                spiral_time(now) + self._config.timespan),
+            spiral_time))
+        compositor.add_layer(Layer(
+            'clock_face', clock_bb,
+            lambda context, now: self._clock.render_face(context)))
+        compositor.add_layer(Layer(
+            'clock_hands', clock_bb,
+            lambda context, now: self._clock.render_hands(
+                context, hands_time(now), self._detail >= ANIMATE_HANDS),
+            hands_time))
+        compositor.add_layer(Layer(
+            'event_list', layer_bb(self._config.event_list.bounding_box),
+            lambda context, now: self._event_list.render(context, now),
+            lambda now: (self._events_version, self._selected_event,
+                         now.date())))
+        compositor.add_layer(Layer(
+            'app_heading', layer_bb(self._config.app_heading.bounding_box),
+            self._app_heading.render,
+            lambda now: now.date()))
+        compositor.add_layer(Layer(
+            'plugin_events', timeline_bb,
+            lambda context, now: self._timeline.render_plugin_events(
+                context, spiral_time(now),
+                spiral_time(now) + self._config.timespan),
+            events_key))
+        compositor.add_layer(Layer(
+            'day_labels', timeline_bb,
+            lambda context, now: self._timeline.render_day_labels(
+                context, spiral_time(now),
+                spiral_time(now) + self._config.timespan),
+            spiral_time))
+
+        return compositor
+
+    def set_timeline_events(self, events):
+        """
+        Pass events on to the components (and bump the events version) if
+        anything that is displayed has changed.
+        """
+        events_key = [(e.plugin(), e.id(), e.start(), e.end(), e.title())
+                      for e in events]
+
+        if events_key != self._events_key:
+            self._events_key = events_key
+            self._events_version += 1
+
+            self._event_list.set_timeline_events(events)
+            self._timeline.set_timeline_events(events)
+
+    def hit_test(self, x, y):
+        """
+        Return the timeline item drawn on the spiral at window coordinates
+        (x, y) in the last frame, or None.
+        """
+        with STAGE_SECONDS.time(stage='hit_test'):
+            return self._timeline.hit_test(x, y)
+
+    def select_event(self, event):
+        """ Highlight event (a timeline item or None) in the event list. """
+        key = (event.plugin(), event.id()) if event is not None else None
+
+        self._selected_event = key
+        self._event_list.set_selected_event(key)
+
+    def invalidate(self):
+        """ Force the whole frame to be redrawn on the next render. """
+        self._compositor.invalidate()
+
+    def render(self, now, context=None):
+        """
+        Render a frame for now.
+        :param context: The context to render onto, if not one for the
+        renderer's surface. Its target must hold the previous frame as only
+        the areas that changed are drawn.
+        :return: A list of Rectangles that changed.
+        """
+        context = context or self.context
+        damage = self._compositor.render(context, now)
+        context.get_target().flush()
+        return damage
+
+
+def create_plugins(config):
+    return [plugin.plugin(plugin.config) for plugin in config.plugins]
+
+
+def get_timeline_events(plugins, now, timespan):
+    """ Collect the timeline items of all plugins, sorted by start. """
+    events = []
+
+    for p in plugins:
+        events += p.get_timeline_items(now, now + timespan)
+
+    events.sort(key=lambda e: e.start())
+    return events
+
+
+def render_frame(config, plugins, renderer, present, now=None):
+    """
+    Render a frame and show it on the display.
+    :param now: The time to render (the current time if None).
+    """
+    now = now or datetime.datetime.now()
+
+    with FRAME_SECONDS.time():
+        with STAGE_SECONDS.time(stage='events'):
+            renderer.set_timeline_events(
+                get_timeline_events(plugins, now, config.timespan))
+
+        damage = renderer.render(now)
+        present(damage)
+
+    if damage:
+        FRAMES_RENDERED.inc()
+    else:
+        FRAMES_SKIPPED.inc()
+
+
+def create_pacer(config, renderer):
+    """ Return a FramePacer if animation is enabled (or None). """
+    if not config.animation.enabled:
+        return None
+
+    pacer = FramePacer(config.animation.fps, config.animation.budget,
+                       config.animation.window,
+                       config.animation.retry_interval_in_seconds)
+    renderer.set_detail(pacer.detail)
+    ANIMATION_DETAIL.set(pacer.detail)
+    return pacer
+
+
+def pace_frame(pacer, renderer, cost, timeout):
+    """
+    Let pacer adapt what is animated to the cost of the frame just rendered.
+    :param cost: The seconds taken to render and present the frame.
+    :param timeout: The seconds until the next minute tick.
+    :return: The seconds until the next frame.
+    """
+    now = time.monotonic()
+
+    if pacer.frame_done(cost, now):
+        renderer.set_detail(pacer.detail)
+        ANIMATION_DETAIL.set(pacer.detail)
+
+    frame_timeout, dropped = pacer.schedule_next(now)
+    if dropped:
+        FRAMES_DROPPED.inc(dropped)
+
+    return timeout if frame_timeout is None else min(timeout, frame_timeout)
+
+
+def start_plugins(plugins, scheduler):
+    for p in plugins:
+        p.add_listener(scheduler.notify)
+        p.start()
+
+
+def stop_plugins(plugins):
+    print("")
+    print("Stopping all plugins.")
+    for p in plugins:
+        p.stop()
+    print("Exiting.")
+
+
+def run(config, plugins, renderer, present):
+    """
+    Start the plugins and keep rendering frames until interrupted, for
+    displays that have no event loop of their own.
+    :param present: A callable taking the damage of each frame that shows
+    the frame on the display.
+    """
+    scheduler = FrameScheduler()
+    pacer = create_pacer(config, renderer)
+    exporter = metrics.create_exporter(config)
+    exporter.start()
+    start_plugins(plugins, scheduler)
+
+    try:
+        while True:
+            start = time.perf_counter()
+            render_frame(config, plugins, renderer, present)
+
+            timeout = None
+            if pacer is not None:
+                timeout = pace_frame(
+                    pacer, renderer, time.perf_counter() - start,
+                    scheduler.get_timeout(datetime.datetime.now()))
+
+            scheduler.wait(timeout)
+
+    except KeyboardInterrupt:
+        stop_plugins(plugins)
+        exporter.stop()
+
+
+def load_fixture(plugins, path):
+    """
+    Load events from a JSON fixture into the first plugin that can take
+    them. The fixture maps calendar ids to lists of Google Calendar event
+    resources.
+    """
+    with open(path) as f:
+        fixture = json.load(f)
+
+    for p in plugins:
+        if hasattr(p, 'load_events'):
+            for calendar_id, events in fixture.items():
+                p.load_events(calendar_id, events)
+            return
+
+    raise ValueError("No plugin can load events from '{}'".format(path))
+
+
+def render_to_file(config, plugins, now, path):
+    """
+    Render a single frame for now without a display and write it to path,
+    as a PNG if path ends in '.png' and as raw ARGB32 pixels otherwise.
+    """
+    surface = cairo.ImageSurface(cairo.FORMAT_ARGB32, config.window.width,
+                                 config.window.height)
+    renderer = Renderer(config, plugins, surface)
+
+    renderer.set_timeline_events(
+        get_timeline_events(plugins, now, config.timespan))
+    renderer.render(now)
+
+    if path.lower().endswith('.png'):
+        surface.write_to_png(path)
+    else:
+        with open(path, 'wb') as f:
+            f.write(surface.get_data())
+
+
+class MainWindow(object):
+    """
+    Shows frames in a Tk window. Tk (and PIL, see put_region) are only
+    imported here so that the other displays and --mode render work without
+    them.
+    """
+
+    def __init__(self, config, debug, render_process=False):
+        """
+        Constructs the MainWindow and runs it until it is closed.
+        :param render_process: Render frames in a separate process (see
+        renderprocess.RenderProcess) rather than on Tk's thread. Frames are
+        then never animated.
+        """
+        import tkinter
+
+        self.root = tkinter.Tk()
+
+        self._config = config
+
+        if not debug:
+            self.root.attributes("-fullscreen", True)
+            self.root.config(cursor="none")
+
+
+        self.size = config.window.width, config.window.height
+        self.root.geometry("{}x{}".format(*self.size))
+
+        self._plugins = create_plugins(config)
+        self._render_process = None
+
+        if render_process:
+            # Needs Python 3.8 or later for multiprocessing.shared_memory.
+            import renderprocess
+
+            # Started before any other threads as the process is forked.
+            self._render_process = renderprocess.RenderProcess(
+                self.size[0], self.size[1], self._plugins,
+                lambda plugins, surface: Renderer(config, plugins, surface))
+            self._render_process.start()
+            self.root.tk.createfilehandler(self._render_process.fileno(),
+                                           tkinter.READABLE,
+                                           lambda fd, mask: self.on_rendered())
+        else:
+            self.surface = cairo.ImageSurface(cairo.FORMAT_ARGB32, *self.size)
+            self._renderer = Renderer(config, self._plugins, self.surface)
+
+        self._pacer = None
+        if self._render_process is None:
+            self._pacer = create_pacer(config, self._renderer)
+
+        # The label shows a persistent photo image that only has the areas
+        # that changed each frame written into it.
+        self.photo = tkinter.PhotoImage(master=self.root, width=self.size[0],
+                                        height=self.size[1])
+        self.label = tkinter.Label(self.root, image=self.photo)
         self.label.pack(expand=True, fill="both")
 
+        # Frames are scheduled on Tk's event loop: a timer for the next
+        # minute boundary and a file handler for plugin notifications.
+        self._scheduler = FrameScheduler()
+        self._frame_timer = None
+        self.root.tk.createfilehandler(self._scheduler.fileno(),
+                                       tkinter.READABLE,
+                                       lambda fd, mask: self.on_frame())
 
-        for p in self._plugins:
-            p.start()
+        # Taps on the touchscreen select events (the render process keeps
+        # the hit index to itself, so not with one).
+        if self._render_process is None:
+            self.label.bind('<Button-1>', self.on_tap)
+
+        self._exporter = metrics.create_exporter(config)
+        self._exporter.start()
+        start_plugins(self._plugins, self._scheduler)
+        self.root.after_idle(self.on_frame)
 
         try:
-            while True:
-                events = []
+            self.root.mainloop()
+        except KeyboardInterrupt:
+            pass
 
-                now = datetime.datetime.now()
+        stop_plugins(self._plugins)
+        self._exporter.stop()
 
-                for p in self._plugins:
-                    events += p.get_timeline_items(now, now + self._config.timespan)
+        if self._render_process is not None:
+            self._render_process.stop()
 
-                events.sort(key=lambda e: e.start())
+    def on_frame(self):
+        """ Render a frame and schedule the next one. """
+        if self._frame_timer is not None:
+            self.root.after_cancel(self._frame_timer)
 
-                self._event_list.set_timeline_events(events)
-                self._timeline.set_timeline_events(events)
+        self._scheduler.clear()
 
-                self.render(now)
-                self.update_idletasks()
-                self.update()
+        if self._render_process is not None:
+            now = datetime.datetime.now()
+            self._render_process.set_timeline_events(
+                get_timeline_events(self._plugins, now, self._config.timespan))
+            self._render_process.request_frame(now)
 
+            timeout = self._scheduler.get_timeout(datetime.datetime.now())
+        else:
+            start = time.perf_counter()
+            render_frame(self._config, self._plugins, self._renderer,
+                         self.present)
 
+            # Make sure the frame is on screen before it is timed.
+            self.root.update_idletasks()
+            cost = time.perf_counter() - start
 
-                time.sleep(5)
+            timeout = self._scheduler.get_timeout(datetime.datetime.now())
 
-        except KeyboardInterrupt:
-            print("")
-            print("Stopping all plugins.")
-            for p in self._plugins:
-                p.stop()
-            print("Exiting.")
+            # Animation is only paced for frames rendered in this process.
+            if self._pacer is not None:
+                timeout = pace_frame(self._pacer, self._renderer, cost,
+                                     timeout)
+
+        self._frame_timer = self.root.after(int(timeout * 1000) + 1,
+                                            self.on_frame)
 
+    def on_tap(self, event):
+        """ Select the event under a tap (or clear the selection). """
+        self._renderer.select_event(self._renderer.hit_test(event.x, event.y))
+        self.on_frame()
 
-    def render(self, now):
+    def on_rendered(self):
+        """ Show a frame finished by the render process. """
+        data, damage = self._render_process.receive_frame()
 
+        if damage:
+            FRAMES_RENDERED.inc()
+        else:
+            FRAMES_SKIPPED.inc()
 
-        self.context.set_operator(cairo.constants.OPERATOR_OVER)
+        for rect in damage:
+            self.put_region(data, self._render_process.stride, rect)
 
-        self.context.rectangle(0, 0, *self.size)
-        self.context.set_source_rgba(*self._config.window.background_colour)
-        self.context.fill()
+    def present(self, damage):
+        """ Copy the areas that changed to the screen. """
+        data = self.surface.get_data()
+        stride = self.surface.get_stride()
 
-        #self.context.set_operator(cairo.constants.OPERATOR_SCREEN)
+        for rect in damage:
+            self.put_region(data, stride, rect)
 
-        self._timeline.render(self.context, now, now + self._config.timespan)
-        self._clock.render(self.context, now)
-        self._event_list.render(self.context)
-        self._app_heading.render(self.context, now)
-        self._timeline.render_plugin_events(self.context, now, now + self._config.timespan)
-        self._timeline.render_day_labels(self.context, now, now + self._config.timespan)
+    def put_region(self, data, stride, rect):
+        """
+        Convert one rectangle of the cairo surface's pixel data and write it
+        into the photo image shown by the label.
+        """
+        import PIL.Image
 
-        new_img = PIL.Image.frombuffer("RGBA", self.size,
-                                   self.surface.get_data(),
-                                   "raw","BGRA", 0, 1)
-        new_tk_img = PIL.ImageTk.PhotoImage(new_img)
+        offset = rect.top * stride + rect.left * 4
 
-        self.label.configure(image=new_tk_img)
-        self.label.image = new_tk_img
-        #panel.image = img2
+        # Cairo's ARGB32 is BGRA in memory on little-endian machines. Only
+        # the rows and columns inside rect are read from the buffer.
+        with STAGE_SECONDS.time(stage='pil_convert'):
+            region = PIL.Image.frombuffer("RGB", (rect.width, rect.height),
+                                          memoryview(data)[offset:],
+                                          "raw", "BGRX", stride, 1)
 
+            ppm = "P6 {} {} 255\n".format(rect.width, rect.height).encode() + \
+                region.tobytes()
 
+        with STAGE_SECONDS.time(stage='tk_update'):
+            self.root.tk.call(self.photo.name, "put", ppm, "-format", "ppm",
+                              "-to", rect.left, rect.top)
 
 
 if __name__ == "__main__":
@@ -682,14 +1332,27 @@ if __name__ == "__main__":
     avoid going in fullscreen mode and to avoid hiding the cursor.
     """
 
-    # Set current directory to main.py's directory.
+    # Set current directory to main.py's directory (paths given on the
+    # command-line are relative to the original one).
+    cwd = os.getcwd()
     abspath = os.path.abspath(__file__)
     dname = os.path.dirname(abspath)
     os.chdir(dname)
 
     # Proccess command-line arguments.
     parser = argparse.ArgumentParser()
-    parser.add_argument('--mode', choices=['release', 'debug', 'auth'], default='release')
+    parser.add_argument('--mode', choices=['release', 'debug', 'auth', 'render'], default='release')
+    parser.add_argument('--display', choices=['tk', 'fbdev'], default='tk')
+    parser.add_argument('--fbdev', default=cfg.framebuffer.device,
+                        help='framebuffer device (or plain file) for --display fbdev')
+    parser.add_argument('--render-process', action='store_true',
+                        help='render in a separate process (Tk display only)')
+    parser.add_argument('--now', type=lambda s: datetime.datetime.strptime(s, '%Y-%m-%dT%H:%M'),
+                        help='time to render in --mode render, e.g. 2018-01-31T09:30')
+    parser.add_argument('--events',
+                        help='JSON fixture of events to render in --mode render')
+    parser.add_argument('--output', default='frame.png',
+                        help='output of --mode render (.png, otherwise raw ARGB32)')
     args = parser.parse_args()
 
     if args.mode == 'auth':
@@ -697,5 +1360,19 @@ if __name__ == "__main__":
             p = plugin.plugin(plugin.config)
             if hasattr(p, 'auth'):
                 p.authenticate()
+    elif args.mode == 'render':
+        # The plugins are never started so nothing is fetched or stored.
+        active_plugins = create_plugins(cfg)
+        if args.events:
+            load_fixture(active_plugins, os.path.join(cwd, args.events))
+        render_to_file(cfg, active_plugins, args.now or datetime.datetime.now(),
+                       os.path.join(cwd, args.output))
+    elif args.display == 'fbdev':
+        active_plugins = create_plugins(cfg)
+        with FrameBuffer(args.fbdev, cfg.window.width, cfg.window.height,
+                         cfg.framebuffer.bits_per_pixel) as fb:
+            renderer = Renderer(cfg, active_plugins, fb.surface)
+            run(cfg, active_plugins, renderer, fb.present)
     else:
-        MainWindow(config=cfg, debug=(args.mode == 'debug'))
+        MainWindow(config=cfg, debug=(args.mode == 'debug'),
+                   render_process=args.render_process)
@@ -0,0 +1,319 @@
+import collections
+import contextlib
+import http.server
+import os
+import threading
+import time
+
+
+def format_labels(labels):
+    """ Format a tuple of (name, value) pairs as Prometheus labels. """
+    if not labels:
+        return ''
+
+    def escape(value):
+        return str(value).replace('\\', '\\\\').replace('"', '\\"') \
+            .replace('\n', '\\n')
+
+    return '{' + ','.join('{}="{}"'.format(name, escape(value))
+                          for name, value in labels) + '}'
+
+
+def get_label_key(labels):
+    return tuple(sorted(labels.items()))
+
+
+class Counter(object):
+    """ A count that only goes up, kept per combination of label values. """
+
+    def __init__(self, name, help):
+        self.name = name
+        self.help = help
+        self._values = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1, **labels):
+        key = get_label_key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels):
+        with self._lock:
+            return self._values.get(get_label_key(labels), 0)
+
+    def exposition(self):
+        """ Return the counter in the Prometheus text format. """
+        lines = ['# HELP {} {}'.format(self.name, self.help),
+                 '# TYPE {} counter'.format(self.name)]
+        with self._lock:
+            for key, value in self._values.items():
+                lines.append('{}{} {}'.format(self.name, format_labels(key),
+                                              value))
+        return lines
+
+
+class Gauge(object):
+    """
+    A value that can go up and down, kept per combination of label values.
+    A value can also be given as a function that is called whenever the
+    gauge is exported (e.g. to report the age of something).
+    """
+
+    def __init__(self, name, help):
+        self.name = name
+        self.help = help
+        self._values = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def set(self, value, **labels):
+        with self._lock:
+            self._values[get_label_key(labels)] = value
+
+    def set_function(self, fn, **labels):
+        """ Report the value returned by fn (a callable without arguments). """
+        self.set(fn, **labels)
+
+    def value(self, **labels):
+        with self._lock:
+            value = self._values.get(get_label_key(labels), 0)
+        return value() if callable(value) else value
+
+    def exposition(self):
+        """ Return the gauge in the Prometheus text format. """
+        with self._lock:
+            values = list(self._values.items())
+
+        lines = ['# HELP {} {}'.format(self.name, self.help),
+                 '# TYPE {} gauge'.format(self.name)]
+        for key, value in values:
+            lines.append('{}{} {}'.format(
+                self.name, format_labels(key),
+                value() if callable(value) else value))
+        return lines
+
+
+class Histogram(object):
+    """
+    Keeps the most recent observations, per combination of label values, to
+    report rolling quantiles and maxima (plus the count and sum of all
+    observations). It is exported as a Prometheus summary.
+    """
+
+    QUANTILES = (0.5, 0.95)
+
+    def __init__(self, name, help, window=600):
+        """
+        Constructs a Histogram.
+        :param window: The number of recent observations that the quantiles
+        and the maximum are computed over.
+        """
+        self.name = name
+        self.help = help
+        self._window = window
+        # Maps label keys to a list [recent observations, count, sum].
+        self._series = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        key = get_label_key(labels)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = [collections.deque(maxlen=self._window), 0, 0.0]
+                self._series[key] = series
+            series[0].append(value)
+            series[1] += 1
+            series[2] += value
+
+    @contextlib.contextmanager
+    def time(self, **labels):
+        """ Observe the time (in seconds) spent in a with statement. """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def get_recent(self, **labels):
+        """ Return the recent observations, sorted. """
+        with self._lock:
+            series = self._series.get(get_label_key(labels))
+            return sorted(series[0]) if series is not None else []
+
+    @staticmethod
+    def get_quantile(values, q):
+        """ Return the q-quantile of sorted values (nearest rank). """
+        if not values:
+            return float('nan')
+        return values[min(len(values) - 1, int(q * len(values)))]
+
+    def quantile(self, q, **labels):
+        return Histogram.get_quantile(self.get_recent(**labels), q)
+
+    def exposition(self):
+        """ Return the histogram in the Prometheus text format. """
+        with self._lock:
+            series = [(key, sorted(recent), count, total)
+                      for key, (recent, count, total) in self._series.items()]
+
+        lines = ['# HELP {} {}'.format(self.name, self.help),
+                 '# TYPE {} summary'.format(self.name)]
+        for key, recent, count, total in series:
+            for q in Histogram.QUANTILES:
+                lines.append('{}{} {}'.format(
+                    self.name, format_labels(key + (('quantile', q),)),
+                    Histogram.get_quantile(recent, q)))
+            lines.append('{}_sum{} {}'.format(self.name, format_labels(key),
+                                              total))
+            lines.append('{}_count{} {}'.format(self.name, format_labels(key),
+                                                count))
+
+        lines += ['# HELP {}_max Largest of the recent observations of {}.'
+                  .format(self.name, self.name),
+                  '# TYPE {}_max gauge'.format(self.name)]
+        for key, recent, _, _ in series:
+            lines.append('{}_max{} {}'.format(
+                self.name, format_labels(key),
+                recent[-1] if recent else float('nan')))
+
+        return lines
+
+
+class Registry(object):
+    """ The metrics of the application, by name. """
+
+    def __init__(self):
+        self._metrics = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get_or_add(self, cls, name, help, *args):
+        """
+        Return the metric called name, adding a new instance of cls if there
+        is none yet.
+        """
+        with self._lock:
+            metric = self._metrics.get(name)
+            if metric is None:
+                metric = cls(name, help, *args)
+                self._metrics[name] = metric
+            elif not isinstance(metric, cls):
+                raise ValueError("Metric '{}' is already registered as a {}"
+                                 .format(name, type(metric).__name__))
+            return metric
+
+    def counter(self, name, help):
+        return self.get_or_add(Counter, name, help)
+
+    def gauge(self, name, help):
+        return self.get_or_add(Gauge, name, help)
+
+    def histogram(self, name, help, window=600):
+        return self.get_or_add(Histogram, name, help, window)
+
+    def exposition(self):
+        """ Return all metrics in the Prometheus text format. """
+        with self._lock:
+            metrics = list(self._metrics.values())
+
+        lines = []
+        for metric in metrics:
+            lines += metric.exposition()
+        return '\n'.join(lines) + '\n'
+
+
+# The registry that the application's metrics are kept in.
+REGISTRY = Registry()
+
+
+def write_textfile(registry, path):
+    """
+    Write the metrics to path, replacing it atomically so that readers such
+    as node_exporter's textfile collector never see a partial file.
+    """
+    directory = os.path.dirname(path)
+    if directory and not os.path.isdir(directory):
+        os.makedirs(directory)
+
+    temp_path = path + '.tmp'
+    with open(temp_path, 'w') as f:
+        f.write(registry.exposition())
+    os.replace(temp_path, path)
+
+
+class Exporter(object):
+    """
+    Publishes a registry in the Prometheus text format by periodically
+    writing it to a file and/or by serving it over HTTP on a local port.
+    """
+
+    def __init__(self, registry, textfile=None, write_interval_in_seconds=15,
+                 port=None, address='127.0.0.1'):
+        """
+        Constructs an Exporter.
+        :param textfile: The file to write the metrics to (or None).
+        :param write_interval_in_seconds: How often to write the file.
+        :param port: The port to serve the metrics on (or None).
+        :param address: The address to serve the metrics on, only the local
+        machine by default.
+        """
+        self._registry = registry
+        self._textfile = textfile
+        self._write_interval = write_interval_in_seconds
+        self._stop = threading.Event()
+        self._writer = None
+        self._server = None
+
+        if textfile:
+            self._writer = threading.Thread(target=self.run_writer,
+                                            daemon=True)
+
+        if port:
+            self._server = http.server.HTTPServer(
+                (address, port), self.create_handler())
+            self._server_thread = threading.Thread(
+                target=self._server.serve_forever, daemon=True)
+
+    def create_handler(self):
+        registry = self._registry
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+
+            def do_GET(self):
+                body = registry.exposition().encode()
+                self.send_response(200)
+                self.send_header('Content-Type',
+                                 'text/plain; version=0.0.4; charset=utf-8')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
+
+    def run_writer(self):
+        while not self._stop.wait(self._write_interval):
+            write_textfile(self._registry, self._textfile)
+
+    def start(self):
+        if self._writer is not None:
+            self._writer.start()
+        if self._server is not None:
+            self._server_thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._writer is not None:
+            self._writer.join()
+            write_textfile(self._registry, self._textfile)
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+
+
+def create_exporter(config):
+    """ Create an Exporter for REGISTRY from the 'metrics' configuration. """
+    return Exporter(REGISTRY, config.metrics.textfile,
+                    config.metrics.write_interval_in_seconds,
+                    config.metrics.port)
@@ -0,0 +1,144 @@
+import datetime
+import json
+import os
+import sqlite3
+import time
+
+
+class EventStore(object):
+    """
+    Keeps the events and sync state of a plugin's calendars in a SQLite
+    database so that they are available straight away on start-up and
+    survive network outages. Events are stored as the JSON resources
+    returned by the API, keyed by calendar and event id.
+    """
+
+    DATETIME_FMT = '%Y-%m-%dT%H:%M:%S'
+
+    # The format of the stored events. Version 1 keeps recurring events as
+    # a whole (with their exceptions) rather than an instance at a time.
+    VERSION = 1
+
+    SCHEMA = '''
+        CREATE TABLE IF NOT EXISTS events (
+            calendar_id TEXT NOT NULL,
+            event_id TEXT NOT NULL,
+            event TEXT NOT NULL,
+            updated REAL NOT NULL,
+            PRIMARY KEY (calendar_id, event_id));
+
+        CREATE TABLE IF NOT EXISTS calendars (
+            calendar_id TEXT PRIMARY KEY,
+            sync_token TEXT,
+            updated REAL NOT NULL);
+
+        CREATE TABLE IF NOT EXISTS sync_window (
+            id INTEGER PRIMARY KEY CHECK (id = 0),
+            synced_from TEXT NOT NULL,
+            synced_until TEXT NOT NULL);
+    '''
+
+    def __init__(self, path):
+        """
+        Constructs an EventStore, creating the database if need be.
+        :param path: The file to store the database in.
+        """
+        directory = os.path.dirname(path)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+
+        # The store is loaded on the thread that starts the plugin and saved
+        # on the plugin runtime's thread pool, never at the same time.
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        self._connection.executescript(EventStore.SCHEMA)
+        self.upgrade()
+
+    def upgrade(self):
+        """
+        Drop events and sync state stored in an older format, so that the
+        next sync is a full one.
+        """
+        version, = self._connection.execute('PRAGMA user_version').fetchone()
+        if version == EventStore.VERSION:
+            return
+
+        with self._connection:
+            self._connection.execute('DELETE FROM events')
+            self._connection.execute('DELETE FROM calendars')
+            self._connection.execute('DELETE FROM sync_window')
+            self._connection.execute(
+                'PRAGMA user_version = {}'.format(EventStore.VERSION))
+
+    def load(self):
+        """
+        Read everything back from the database.
+        :return: A tuple (calendar_events, sync_tokens, synced_from,
+        synced_until) where calendar_events maps calendar ids to dictionaries
+        of events keyed by event id, sync_tokens maps calendar ids to sync
+        tokens and the last two are datetimes (or None if nothing was synced).
+        """
+        calendar_events = {}
+        sync_tokens = {}
+        synced_from = None
+        synced_until = None
+
+        for calendar_id, event_id, event in self._connection.execute(
+                'SELECT calendar_id, event_id, event FROM events'):
+            calendar_events.setdefault(calendar_id, {})[event_id] = \
+                json.loads(event)
+
+        for calendar_id, sync_token in self._connection.execute(
+                'SELECT calendar_id, sync_token FROM calendars'):
+            sync_tokens[calendar_id] = sync_token
+
+        row = self._connection.execute(
+            'SELECT synced_from, synced_until FROM sync_window').fetchone()
+        if row is not None:
+            synced_from = datetime.datetime.strptime(row[0], EventStore.DATETIME_FMT)
+            synced_until = datetime.datetime.strptime(row[1], EventStore.DATETIME_FMT)
+
+        return calendar_events, sync_tokens, synced_from, synced_until
+
+    def save(self, synced_from, synced_until, changes):
+        """
+        Write the outcome of a sync in a single transaction.
+        :param synced_from: The start of the synced window.
+        :param synced_until: The end of the synced window.
+        :param changes: A dictionary mapping calendar ids to a tuple (full,
+        updated, removed, sync_token) where full is True if all of the
+        calendar's events were fetched (replacing any stored ones), updated
+        maps event ids to events, removed is a collection of event ids to
+        delete and sync_token is the calendar's new sync token.
+        """
+        now = time.time()
+
+        with self._connection:
+
+            self._connection.execute(
+                'INSERT OR REPLACE INTO sync_window VALUES (0, ?, ?)',
+                (synced_from.strftime(EventStore.DATETIME_FMT),
+                 synced_until.strftime(EventStore.DATETIME_FMT)))
+
+            for calendar_id, (full, updated, removed, sync_token) in \
+                    changes.items():
+
+                if full:
+                    self._connection.execute(
+                        'DELETE FROM events WHERE calendar_id = ?',
+                        (calendar_id,))
+
+                self._connection.executemany(
+                    'DELETE FROM events WHERE calendar_id = ? AND event_id = ?',
+                    [(calendar_id, event_id) for event_id in removed])
+
+                self._connection.executemany(
+                    'INSERT OR REPLACE INTO events VALUES (?, ?, ?, ?)',
+                    [(calendar_id, event_id, json.dumps(event), now)
+                     for event_id, event in updated.items()])
+
+                self._connection.execute(
+                    'INSERT OR REPLACE INTO calendars VALUES (?, ?, ?)',
+                    (calendar_id, sync_token, now))
+
+    def close(self):
+        self._connection.close()
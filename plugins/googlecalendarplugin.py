@@ -1,9 +1,11 @@
 from __future__ import print_function
 
 import argparse
+import contextlib
 import datetime
 import httplib2
 import apiclient
+import apiclient.errors
 import oauth2client.client
 import oauth2client.file
 import oauth2client.tools
@@ -11,79 +13,184 @@ import os
 import threading
 import time
 
-import pprint
-
 import cairocffi as cairo
 
+import metrics
+import plugins.eventstore as eventstore
+import plugins.intervalindex as intervalindex
 import plugins.plugin as plugin
+import plugins.recurrence as recurrence
+import plugins.runtime as runtime
+
+# Metrics of the API calls, labelled by call (e.g. 'events.list').
+API_CALL_SECONDS = metrics.REGISTRY.histogram(
+    'calendar_api_call_seconds',
+    'Time taken by Google Calendar API calls (a whole batch for events.list).')
+
+API_REQUESTS = metrics.REGISTRY.counter(
+    'calendar_api_requests_total',
+    'HTTP requests made to the Google Calendar API.')
+
+API_REQUEST_BYTES = metrics.REGISTRY.counter(
+    'calendar_api_request_bytes_total',
+    'Bytes sent to the Google Calendar API (headers and body).')
+
+API_RESPONSE_BYTES = metrics.REGISTRY.counter(
+    'calendar_api_response_bytes_total',
+    'Bytes received from the Google Calendar API (headers and decoded body).')
+
+API_ERRORS = metrics.REGISTRY.counter(
+    'calendar_api_errors_total',
+    'Google Calendar API calls (or requests in a batch) that failed.')
+
+API_RETRIES = metrics.REGISTRY.counter(
+    'calendar_api_retries_total',
+    'Syncs started again, labelled by the reason.')
+
+EVENTS_RECEIVED = metrics.REGISTRY.counter(
+    'calendar_events_received_total',
+    'Events (including cancellations) returned by events.list, per calendar.')
+
+DATA_AGE_SECONDS = metrics.REGISTRY.gauge(
+    'calendar_data_age_seconds',
+    'Time since each calendar was last synced successfully.')
+
+
+class CountingHttp(httplib2.Http):
+    """
+    An httplib2.Http that counts requests and the bytes sent and received,
+    attributing them to the API call in progress (see
+    GoogleCalendarPlugin.track_call).
+    """
+
+    def __init__(self, *args, **kwargs):
+        httplib2.Http.__init__(self, *args, **kwargs)
+        self.call = 'other'
+
+    @staticmethod
+    def get_headers_size(headers):
+        return sum(len(str(name)) + len(str(value))
+                   for name, value in (headers or {}).items())
+
+    def request(self, uri, method='GET', body=None, headers=None, *args,
+                **kwargs):
+        call = self.call
+        API_REQUESTS.inc(call=call)
+        API_REQUEST_BYTES.inc(len(method) + len(uri) + len(body or '') +
+                              CountingHttp.get_headers_size(headers),
+                              call=call)
+
+        response, content = httplib2.Http.request(self, uri, method, body,
+                                                  headers, *args, **kwargs)
+
+        API_RESPONSE_BYTES.inc(len(content or b'') +
+                               CountingHttp.get_headers_size(response),
+                               call=call)
+        return response, content
 
 
 class GoogleCalendarTimelineItem(plugin.TimelineItem):
+    """
+    A Google Calendar event (or a changed instance of a recurring event).
+    The event resource is parsed once on creation and only the fields needed
+    for rendering are kept.
+    """
+
+    __slots__ = ('_id', '_title', '_start', '_end', '_all_day', '_plugin',
+                 '_recurring_event_id', '_original_start')
 
     STRPDATE_FMT = '%Y-%m-%d'
     STRPTIME_FMT = '%Y-%m-%dT%H:%M:%SZ'
 
     def __init__(self, event, plug):
-        self._event = event
+        self._id = event['id']
+        self._title = event.get('summary', '')
+        self._start = GoogleCalendarTimelineItem.parse_time(event['start'])
+        self._end = GoogleCalendarTimelineItem.parse_time(event['end'])
+        self._all_day = 'date' in event['start']
         self._plugin = plug
+        self._recurring_event_id = event.get('recurringEventId')
+        self._original_start = GoogleCalendarTimelineItem.parse_time(
+            event.get('originalStartTime', {}))
         plugin.TimelineItem.__init__(self)
 
+    @staticmethod
+    def parse_time(value):
+        """
+        Parse the start or end of an event resource (either a 'dateTime' in
+        UTC or, for all-day events, a 'date').
+        """
+        if 'dateTime' in value:
+            return datetime.datetime.strptime(
+                value['dateTime'],
+                GoogleCalendarTimelineItem.STRPTIME_FMT)
+        elif 'date' in value:
+            return datetime.datetime.strptime(
+                value['date'],
+                GoogleCalendarTimelineItem.STRPDATE_FMT)
+        return None
+
     def id(self):
-        return self._event['id']
+        return self._id
 
     def start(self):
-        result = None
-        start = self._event['start']
-        if 'dateTime' in start:
-            result = datetime.datetime.strptime(
-                start['dateTime'],
-                GoogleCalendarTimelineItem.STRPTIME_FMT)
-        elif 'date' in start:
-            result = datetime.datetime.strptime(
-                start['date'],
-                GoogleCalendarTimelineItem.STRPDATE_FMT)
-            result.replace(hour=0, minute=0, second=0, microsecond=0)
-        return result
+        return self._start
 
     def end(self):
-        result = None
-        end = self._event['end']
-        if 'dateTime' in end:
-            result = datetime.datetime.strptime(
-                end['dateTime'],
-                GoogleCalendarTimelineItem.STRPTIME_FMT)
-        elif 'date' in end:
-            result = datetime.datetime.strptime(
-                end['date'],
-                GoogleCalendarTimelineItem.STRPDATE_FMT)
-            result.replace(hour=23, minute=59, second=59, microsecond=0)
-        return result
-
-    def event(self):
-        return self._event
+        return self._end
 
     def plugin(self):
         return self._plugin
 
     def title(self):
-        return self._event['summary']
+        return self._title
 
     def is_all_day_event(self):
-        return 'date' in self._event['start']
+        return self._all_day
+
+    def recurring_event_id(self):
+        """ The id of the recurring event this is an instance of (or None). """
+        return self._recurring_event_id
+
+    def original_start(self):
+        """ The start of the instance of the recurring event it replaces. """
+        return self._original_start
 
 
-class GoogleCalendarPlugin(plugin.Plugin):
+class GoogleCalendarPlugin(runtime.AsyncPlugin):
+
+    # The Google API accepts up to 50 requests in a single batch.
+    MAX_BATCH_SIZE = 50
+
+    # Styles for timed and all-day events, matching render_on_clockface.
+    CLOCKFACE_STYLES = [
+        plugin.ClockfaceStyle((1, 0, 0, 1), 10, ([], 0),
+                              cairo.constants.LINE_CAP_ROUND, None),
+        plugin.ClockfaceStyle((1, 0, 0, 1), 2, ([], 0),
+                              cairo.constants.LINE_CAP_ROUND, 10)
+    ]
+
+    # Only request the parts of each event that are used (see create_item),
+    # plus the status to spot cancelled events while syncing.
+    EVENT_FIELDS = 'items(id,status,summary,start,end,recurrence,' \
+        'recurringEventId,originalStartTime),nextPageToken,nextSyncToken'
 
     def __init__(self, config):
         self._config = config
         self._credentials = None
         self._service = None
-        self._events = []
-        self._last_start = None
-        self._last_end = None
-        self._thread = threading.Thread(target=self.run)
-        self._thread_stop = threading.Event()
-        plugin.Plugin.__init__(self)
+        self._calendar_events = {}
+        self._index = intervalindex.IntervalIndex()
+        self._recurrences = recurrence.RecurrenceIndex()
+        self._index_lock = threading.Lock()
+        self._sync_tokens = {}
+        self._errors = {}
+        self._synced_from = None
+        self._synced_until = None
+        self._store = None
+        self._http = None
+        self._synced_at = {}
+        runtime.AsyncPlugin.__init__(self)
 
     def authenticate(self):
         """Gets valid user credentials from storage.
@@ -98,9 +205,16 @@ class GoogleCalendarPlugin(plugin.Plugin):
         self._credentials = self.get_credentials()
 
     def get_timeline_items(self, start, end):
-        self._last_start = start
-        self._last_end = end
-        return self._events
+        self.set_window(start, end)
+        with self._index_lock:
+            return self._index.query(start, end) + \
+                self._recurrences.query(start, end)
+
+    def get_clockface_styles(self):
+        return GoogleCalendarPlugin.CLOCKFACE_STYLES
+
+    def get_clockface_style_id(self, timeline_item):
+        return 1 if timeline_item.is_all_day_event() else 0
 
     def render_on_clockface(self, cairo_context, start_utc, end_utc, timeline_item, point_generator, line_generator):
 
@@ -130,8 +244,9 @@ class GoogleCalendarPlugin(plugin.Plugin):
             point1 = point_generator(timeline_item.start())
             point2 = point_generator(timeline_item.end())
 
+            # A closed subpath of one point is drawn as a dot.
             cairo_context.move_to(*point1)
-            cairo_context.move_to(*point1)
+            cairo_context.close_path()
 
             cairo_context.set_source_rgba(1, 0, 0, 1)
             cairo_context.set_line_width(10)
@@ -140,7 +255,7 @@ class GoogleCalendarPlugin(plugin.Plugin):
             cairo_context.stroke()
 
             cairo_context.move_to(*point2)
-            cairo_context.move_to(*point2)
+            cairo_context.close_path()
 
             cairo_context.set_source_rgba(1, 0, 0, 1)
             cairo_context.set_line_width(10)
@@ -167,75 +282,336 @@ class GoogleCalendarPlugin(plugin.Plugin):
         return credentials
 
     def get_service(self, credentials):
-        http = credentials.authorize(httplib2.Http())
+        self._http = CountingHttp()
+        http = credentials.authorize(self._http)
         return apiclient.discovery.build('calendar', 'v3', http=http)
 
+    @contextlib.contextmanager
+    def track_call(self, call):
+        """
+        Time the API call made in a with statement, count it if it fails and
+        attribute the HTTP traffic in the meantime to it.
+        """
+        if self._http is not None:
+            self._http.call = call
+
+        try:
+            with API_CALL_SECONDS.time(call=call):
+                yield
+        except Exception:
+            API_ERRORS.inc(call=call)
+            raise
+        finally:
+            if self._http is not None:
+                self._http.call = 'other'
+
+    def set_synced(self, calendar_id):
+        """ Record that a calendar has just been synced successfully. """
+        if calendar_id not in self._synced_at:
+            DATA_AGE_SECONDS.set_function(
+                lambda: time.time() - self._synced_at[calendar_id],
+                calendar=calendar_id)
+        self._synced_at[calendar_id] = time.time()
+
     def get_calendars(self, service):
         """
         Get selected calendars from Google Calendar API.
         :param service:
         :return:
         """
-        api_result = service.calendarList().list(
-            fields='items(id, selected, summary)'
-        ).execute()
+        with self.track_call('calendarList.list'):
+            api_result = service.calendarList().list(
+                fields='items(id, selected, summary)'
+            ).execute()
 
         return [r for r in api_result['items'] if 'selected' in r]
 
     def get_events(self, service, calendars, start, end):
+        """
+        Bring the events of all calendars up to date and return them (as
+        returned by create_item).
+
+        The first call does a full sync of the window from start spanning
+        sync_horizon_in_days. After that only the changes since the previous
+        call are requested using each calendar's sync token. Once the
+        requested time frame moves past the synced window a new full sync is
+        done.
+
+        Recurring events are fetched as a whole, with the instances that
+        were changed or cancelled as exceptions, rather than an instance at
+        a time. Their instances are expanded locally (see
+        recurrence.RecurrenceIndex) so they cost nothing to sync and are
+        shown beyond the synced window too.
+
+        The requests for all calendars are sent together in batches (one HTTP
+        round-trip per page rather than per calendar per page). A calendar
+        that fails to sync keeps its previous events and its error is
+        recorded in self._errors.
+        """
+        if self._synced_until is None or end > self._synced_until:
+            self._sync_tokens = {}
+            self._synced_from = start
+            self._synced_until = start + datetime.timedelta(
+                days=self._config.sync_horizon_in_days)
+
+        self._errors = {}
+
+        # Calendars that still have pages to fetch, mapped to the parameters
+        # of the next request and the events merged so far.
+        pending = dict((calendar['id'], self.start_sync(calendar['id']))
+                       for calendar in calendars)
+
+        # The events updated and removed so far in each pending calendar.
+        merged = {}
+
+        # What changed in each calendar that finished syncing, to be saved to
+        # the event store.
+        changes = {}
+
+        while pending:
+
+            requests = dict(
+                (calendar_id, service.events().list(
+                    calendarId=calendar_id,
+                    maxResults=self._config.page_size,
+                    singleEvents=False,
+                    timeZone='UTC',
+                    fields=GoogleCalendarPlugin.EVENT_FIELDS,
+                    **params))
+                for calendar_id, (params, _) in pending.items())
+
+            with self.track_call('events.list'):
+                results = self.execute_batch(service, requests)
+
+            for calendar_id, (api_result, error) in results.items():
+
+                params, events = pending[calendar_id]
+
+                if error is not None:
+                    if isinstance(error, apiclient.errors.HttpError) and \
+                            error.resp.status == 410 and 'syncToken' in params:
+                        # The sync token has expired, start a full sync.
+                        API_RETRIES.inc(reason='sync_token_expired')
+                        del self._sync_tokens[calendar_id]
+                        pending[calendar_id] = self.start_sync(calendar_id)
+                        merged.pop(calendar_id, None)
+                    else:
+                        print('Failed to sync calendar {}: {}'.format(
+                            calendar_id, error))
+                        API_ERRORS.inc(call='events.list')
+                        self._errors[calendar_id] = error
+                        del pending[calendar_id]
+                    continue
+
+                updated, removed = merged.setdefault(calendar_id, ({}, set()))
+
+                items = api_result.get('items', [])
+                EVENTS_RECEIVED.inc(len(items), calendar=calendar_id)
+
+                for event in items:
+                    if GoogleCalendarPlugin.is_removed(event):
+                        events.pop(event['id'], None)
+                        updated.pop(event['id'], None)
+                        removed.add(event['id'])
+                    else:
+                        events[event['id']] = self.create_item(event)
+                        updated[event['id']] = event
+                        removed.discard(event['id'])
+
+                if 'nextPageToken' in api_result:
+                    params['pageToken'] = api_result['nextPageToken']
+                else:
+                    if 'syncToken' in params:
+                        self.update_index(calendar_id, removed,
+                                          [events[event_id] for event_id in updated])
+                    else:
+                        self.update_index(calendar_id,
+                                          self._calendar_events.get(calendar_id, {}).keys(),
+                                          events.values())
+                    self._calendar_events[calendar_id] = events
+                    self._sync_tokens[calendar_id] = api_result.get('nextSyncToken')
+                    changes[calendar_id] = ('syncToken' not in params,
+                                            updated, removed,
+                                            self._sync_tokens[calendar_id])
+                    self.set_synced(calendar_id)
+                    del pending[calendar_id]
+
+        if self._store is not None:
+            self._store.save(self._synced_from, self._synced_until, changes)
+
+        return [item for events in self._calendar_events.values()
+                for item in events.values()]
+
+    @staticmethod
+    def is_removed(event):
+        """
+        Return True if an event resource removes an event. Cancelled
+        instances of recurring events are kept as exceptions to them.
+        """
+        return event.get('status') == 'cancelled' and \
+            'recurringEventId' not in event
+
+    def create_item(self, event):
+        """
+        Return what an event resource is kept as: a RecurringEvent for a
+        recurring event (which is expanded locally rather than fetched an
+        instance at a time), a CancelledInstance for a cancelled instance of
+        one and otherwise a GoogleCalendarTimelineItem.
+        """
+        parse_time = GoogleCalendarTimelineItem.parse_time
+
+        if event.get('status') == 'cancelled':
+            return recurrence.CancelledInstance(
+                event['id'], event['recurringEventId'],
+                parse_time(event['originalStartTime']))
+
+        if 'recurrence' in event:
+            return recurrence.RecurringEvent(
+                event['id'], event.get('summary', ''),
+                parse_time(event['start']), parse_time(event['end']),
+                'date' in event['start'], event['start'].get('timeZone'),
+                event['recurrence'], self)
+
+        return GoogleCalendarTimelineItem(event, self)
 
-        events = []
+    def update_index(self, calendar_id, removed_ids, items):
+        """
+        Remove events from, and add or replace events in, the indices used
+        to answer get_timeline_items.
+        """
+        with self._index_lock:
+            for event_id in removed_ids:
+                self._index.remove((calendar_id, event_id))
+                self._recurrences.remove((calendar_id, event_id))
+            for item in items:
+                key = (calendar_id, item.id())
+
+                # An event can turn into a recurring event and back.
+                self._index.remove(key)
+                self._recurrences.remove(key)
+
+                if isinstance(item, recurrence.RecurringEvent):
+                    self._recurrences.add_event(key, item)
+                    continue
+
+                if item.recurring_event_id() is not None:
+                    self._recurrences.add_exception(
+                        key, (calendar_id, item.recurring_event_id()),
+                        item.original_start())
+
+                if isinstance(item, GoogleCalendarTimelineItem):
+                    self._index.add(key, item.start(), item.end(), item)
+
+    def start_sync(self, calendar_id):
+        """
+        Return the parameters for the first request to sync a calendar and
+        the events to merge the results into. Without a sync token this is a
+        full sync of the synced window into an empty set of events, with one
+        the changes are merged into a copy of the calendar's events that
+        only replaces them once the last page has arrived (so a sync that
+        fails part way leaves them untouched).
+        """
+        sync_token = self._sync_tokens.get(calendar_id)
 
-        pp = pprint.PrettyPrinter()
+        if sync_token is not None:
+            return ({'syncToken': sync_token},
+                    dict(self._calendar_events.get(calendar_id, {})))
 
-        for calendar in calendars:
+        return ({'timeMin': self._synced_from.isoformat() + 'Z',
+                 'timeMax': self._synced_until.isoformat() + 'Z'}, {})
 
-            start_in = start.isoformat() + 'Z'
-            end_in = end.isoformat() + 'Z'
+    def execute_batch(self, service, requests):
+        """
+        Execute requests in as few HTTP round-trips as possible.
+        :param requests: A dictionary of API requests.
+        :return: A dictionary with the same keys mapping to a tuple
+        (response, exception) where exactly one of the two is None.
+        """
+        keys = list(requests.keys())
+        results = {}
 
-            api_result = service.events().list(
-                calendarId=calendar['id'],
-                timeMin=start_in,
-                timeMax=end_in, maxResults=10,
-                singleEvents=True,
-                orderBy='startTime').execute()
+        def callback(request_id, response, exception):
+            results[keys[int(request_id)]] = (response, exception)
 
-            events += api_result.get('items', [])
+        for first in range(0, len(keys), GoogleCalendarPlugin.MAX_BATCH_SIZE):
+            batch = service.new_batch_http_request(callback=callback)
+            for i in range(first, min(len(keys), first + GoogleCalendarPlugin.MAX_BATCH_SIZE)):
+                batch.add(requests[keys[i]], request_id=str(i))
+            batch.execute()
 
-        #pp.pprint(events)
-        return [GoogleCalendarTimelineItem(event, self) for event in events]
+        return results
 
     def get_colours(self, service):
-        colorsResult = service.colors().get().execute()
+        with self.track_call('colors.get'):
+            colorsResult = service.colors().get().execute()
         #print(colorsResult)
 
         #pp = pprint.PrettyPrinter()
         #pp.pprint(colorsResult)
 
-    def run(self):
-
+    def connect(self):
         self._credentials = self.get_credentials()
         self._service = self.get_service(self._credentials)
         self._calendars = self.get_calendars(self._service)
         self._colours = self.get_colours(self._service)
 
-        while not self._thread_stop.is_set():
-
-            if self._last_start is not None and self._last_end is not None:
-                self._events = self.get_events(self._service, self._calendars, self._last_start, self._last_end)
-                self._thread_stop.wait(self._config.update_frequency_in_seconds)
-            else:
-                self._thread_stop.wait(1)
-
-    def start(self):
-        self._thread.start()
-
-    def stop(self):
-        self._thread_stop.set()
-        self._thread.join()
+    def get_refresh_interval(self):
+        return self._config.update_frequency_in_seconds
+
+    async def refresh(self, start, end):
+        # The Google API client blocks, so it is used from the runtime's
+        # thread pool.
+        try:
+            if self._service is None:
+                await self.run_blocking(self.connect)
+            await self.run_blocking(self.get_events, self._service,
+                                    self._calendars, start, end)
+            self.notify_listeners()
+        except (httplib2.HttpLib2Error, apiclient.errors.HttpError,
+                OSError) as e:
+            # Keep showing the events we have until the network comes back.
+            print('Failed to update events: {}'.format(e))
+            API_RETRIES.inc(reason='reconnect')
+            self._service = None
+
+    def load_store(self):
+        """
+        Open the event store (if configured) and load the events and sync
+        state saved by a previous run.
+        """
+        if not self._config.event_store_file:
+            return
 
+        self._store = eventstore.EventStore(self._config.event_store_file)
 
+        calendar_events, self._sync_tokens, self._synced_from, \
+            self._synced_until = self._store.load()
 
+        self._calendar_events = dict(
+            (calendar_id, dict((event_id, self.create_item(event))
+                               for event_id, event in events.items()))
+            for calendar_id, events in calendar_events.items())
 
+        for calendar_id, events in self._calendar_events.items():
+            self.update_index(calendar_id, [], events.values())
 
+    def start(self):
+        # Load saved events before any network I/O so they can be shown
+        # straight away.
+        self.load_store()
+        runtime.AsyncPlugin.start(self)
 
+    def load_events(self, calendar_id, events):
+        """
+        Replace the events of a calendar with event resources obtained
+        elsewhere (e.g. a JSON fixture) without any network access.
+        :param calendar_id: The calendar the events belong to.
+        :param events: A list of event resources as returned by the API.
+        """
+        items = dict((event['id'], self.create_item(event))
+                     for event in events
+                     if not GoogleCalendarPlugin.is_removed(event))
+        self.update_index(calendar_id,
+                          self._calendar_events.get(calendar_id, {}).keys(),
+                          items.values())
+        self._calendar_events[calendar_id] = items
@@ -0,0 +1,88 @@
+import bisect
+import datetime
+
+
+class IntervalIndex(object):
+    """
+    An index of items that each span a time frame, supporting incremental
+    updates and queries for the items that overlap a given time frame.
+
+    Items are grouped into buckets by the order of magnitude of their
+    duration (in powers of two seconds) and each bucket is kept sorted by
+    start. An item in a bucket can only overlap the query if it starts after
+    the query's start minus the bucket's longest possible duration and before
+    the query's end. That range is found by binary search and because all
+    durations in a bucket are within a factor of two of each other it holds
+    few items that don't overlap, so a query costs about O(log n + k) for k
+    results.
+    """
+
+    def __init__(self):
+        # Maps each bucket to a list of (start, key) tuples sorted by start.
+        self._buckets = {}
+        # Maps each key to a tuple (bucket, start, end, item).
+        self._items = {}
+
+    def __len__(self):
+        return len(self._items)
+
+    def __contains__(self, key):
+        return key in self._items
+
+    @staticmethod
+    def get_bucket(start, end):
+        """ Return the bucket for an item from start to end. """
+        seconds = int((end - start).total_seconds())
+        return max(seconds, 0).bit_length()
+
+    def add(self, key, start, end, item):
+        """
+        Add an item to the index, replacing any item with the same key.
+        :param key: A unique, orderable key for the item.
+        :param start: The start of the item's time frame.
+        :param end: The end of the item's time frame.
+        :param item: The item to return from queries.
+        """
+        if key in self._items:
+            self.remove(key)
+
+        bucket = IntervalIndex.get_bucket(start, end)
+        bisect.insort(self._buckets.setdefault(bucket, []), (start, key))
+        self._items[key] = (bucket, start, end, item)
+
+    def remove(self, key):
+        """ Remove the item with key from the index (if present). """
+        if key not in self._items:
+            return
+
+        bucket, start, _, _ = self._items.pop(key)
+        entries = self._buckets[bucket]
+        del entries[bisect.bisect_left(entries, (start, key))]
+
+        if not entries:
+            del self._buckets[bucket]
+
+    def clear(self):
+        self._buckets = {}
+        self._items = {}
+
+    def query(self, start, end):
+        """
+        Return the items overlapping the time frame from start to end. Items
+        that take no time are included if they are within the time frame.
+        """
+        result = []
+
+        for bucket, entries in self._buckets.items():
+
+            # Longest duration an item in this bucket can have.
+            longest = datetime.timedelta(seconds=2 ** bucket)
+            lo = bisect.bisect_left(entries, (start - longest,))
+            hi = bisect.bisect_left(entries, (end,))
+
+            for i in range(lo, hi):
+                _, item_start, item_end, item = self._items[entries[i][1]]
+                if item_end > start or item_start >= start:
+                    result.append(item)
+
+        return result
@@ -1,12 +1,23 @@
 import abc
+import collections
 import datetime
 import six
 
+# How a plugin draws a group of items on the clockface when events are
+# rendered in bulk (see Plugin.get_clockface_styles). If end_cap_width is
+# not None a round dot of that width is drawn where each item starts and
+# ends.
+ClockfaceStyle = collections.namedtuple("ClockfaceStyle", ["colour",
+    "line_width", "dash_style", "line_cap", "end_cap_width"])
+
 
 @six.add_metaclass(abc.ABCMeta)
 class TimelineItem(object):
     """ Object used to represent an item on a timeline. """
 
+    # Allow subclasses to use __slots__ (there can be many items).
+    __slots__ = ()
+
     def __init__(self):
         """
         Constructs a TimelineItem.
@@ -42,6 +53,24 @@ class TimelineItem(object):
 class Plugin(object):
     """ An abstract base class for a plugin. """
 
+    def __init__(self):
+        """
+        Constructs a Plugin.
+        """
+        self._listeners = []
+
+    def add_listener(self, listener):
+        """
+        Register a callable that is called (possibly from another thread)
+        whenever the plugin has new data to display.
+        """
+        self._listeners.append(listener)
+
+    def notify_listeners(self):
+        """ Tell all listeners that there is new data to display. """
+        for listener in self._listeners:
+            listener()
+
     @abc.abstractmethod
     def start(self):
         """ Start any active component within the plugin. """
@@ -62,6 +91,21 @@ class Plugin(object):
         """
         pass
 
+    def get_clockface_styles(self):
+        """
+        Return a list of ClockfaceStyles if the plugin's items can be drawn
+        in bulk as plain strokes along the spiral, or None if every item must
+        be drawn through render_on_clockface.
+        """
+        return None
+
+    def get_clockface_style_id(self, timeline_item):
+        """
+        Return the index into get_clockface_styles() of the style to draw
+        timeline_item with, or None to draw it through render_on_clockface.
+        """
+        return None
+
     @abc.abstractmethod
     def render_on_clockface(self, cairo_context, timeline_item, point_generator, line_generator):
         """
@@ -74,6 +118,9 @@ class Plugin(object):
         :param point_generator: A callable that takes a begin time and end time
         and and returns a collection of point representing the spiral on the
         clockface associated with that timespan.
+
+        Points are returned in the user space of cairo_context, which is
+        rotated along with the spiral, so they should be drawn as-is.
         """
         pass
 
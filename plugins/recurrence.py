@@ -0,0 +1,289 @@
+import datetime
+import re
+
+import dateutil.rrule
+import dateutil.tz
+
+import plugins.plugin as plugin
+
+EPOCH = datetime.datetime(1970, 1, 1)
+
+# The UNTIL part of an RRULE or EXRULE given as a date-time.
+UNTIL_DATE_TIME = re.compile(r'(UNTIL=\d{8})T\d{6}Z?', re.IGNORECASE)
+
+
+class RecurringEventInstance(plugin.TimelineItem):
+    """ An instance of a RecurringEvent, expanded locally. """
+
+    __slots__ = ('_id', '_title', '_start', '_end', '_all_day', '_plugin')
+
+    def __init__(self, id, title, start, end, all_day, plug):
+        self._id = id
+        self._title = title
+        self._start = start
+        self._end = end
+        self._all_day = all_day
+        self._plugin = plug
+        plugin.TimelineItem.__init__(self)
+
+    def id(self):
+        return self._id
+
+    def start(self):
+        return self._start
+
+    def end(self):
+        return self._end
+
+    def plugin(self):
+        return self._plugin
+
+    def title(self):
+        return self._title
+
+    def is_all_day_event(self):
+        return self._all_day
+
+
+class CancelledInstance(object):
+    """ A cancelled instance of a recurring event (an exception to it). """
+
+    __slots__ = ('_id', '_recurring_event_id', '_original_start')
+
+    def __init__(self, id, recurring_event_id, original_start):
+        self._id = id
+        self._recurring_event_id = recurring_event_id
+        self._original_start = original_start
+
+    def id(self):
+        return self._id
+
+    def recurring_event_id(self):
+        return self._recurring_event_id
+
+    def original_start(self):
+        return self._original_start
+
+
+class RecurringEvent(object):
+    """
+    A recurring event: its first instance plus the RFC 5545 RRULE, EXRULE,
+    RDATE and EXDATE lines that repeat it. The rules are applied in the
+    event's own time zone (so a 9 o'clock meeting stays at 9 o'clock across
+    daylight saving changes) and instances are returned in naive UTC like
+    all other timeline items.
+    """
+
+    def __init__(self, id, title, start, end, all_day, time_zone, recurrence,
+                 plug):
+        """
+        Constructs a RecurringEvent.
+        :param start: The start of the first instance (naive UTC, or the
+        date at midnight for all-day events).
+        :param end: The end of the first instance.
+        :param time_zone: The name of the time zone the rules are in (or
+        None for UTC).
+        :param recurrence: A list of recurrence lines.
+        """
+        self._id = id
+        self._title = title
+        self._start = start
+        self._duration = end - start
+        self._all_day = all_day
+        self._time_zone = time_zone
+        self._recurrence = recurrence
+        self._plugin = plug
+        self._rules = None
+
+    def id(self):
+        return self._id
+
+    def start(self):
+        return self._start
+
+    def duration(self):
+        return self._duration
+
+    def get_rules(self):
+        """ Return the dateutil rruleset for the event, parsed once. """
+        if self._rules is None:
+            dtstart = self._start
+            lines = self._recurrence
+            if self._all_day:
+                # All-day instances are naive dates, which dateutil can't
+                # compare to a UTC UNTIL, so only the date of UNTIL is kept.
+                # Instances start at midnight so none are gained or lost.
+                lines = [UNTIL_DATE_TIME.sub(r'\1', line) for line in lines]
+            else:
+                zone = dateutil.tz.gettz(self._time_zone) \
+                    if self._time_zone else None
+                dtstart = dtstart.replace(tzinfo=dateutil.tz.UTC) \
+                    .astimezone(zone or dateutil.tz.UTC)
+
+            try:
+                self._rules = dateutil.rrule.rrulestr(
+                    '\n'.join(lines), dtstart=dtstart,
+                    forceset=True)
+                # Catch rules that only fail once they are used.
+                self._rules.after(dtstart)
+            except (ValueError, TypeError) as e:
+                print('Failed to parse the recurrence of event {}: {}'
+                      .format(self._id, e))
+                self._rules = dateutil.rrule.rruleset()
+                self._rules.rdate(dtstart)
+
+        return self._rules
+
+    def get_instance_starts(self, start, end):
+        """ Return the starts of the instances that start from start to end. """
+        if self._all_day:
+            occurrences = self.get_rules().between(start, end, inc=True)
+        else:
+            occurrences = [
+                o.astimezone(dateutil.tz.UTC).replace(tzinfo=None)
+                for o in self.get_rules().between(
+                    start.replace(tzinfo=dateutil.tz.UTC),
+                    end.replace(tzinfo=dateutil.tz.UTC), inc=True)]
+
+        return [o for o in occurrences if o < end]
+
+    def create_instance(self, start):
+        """ Return the RecurringEventInstance starting at start. """
+        if self._all_day:
+            suffix = start.strftime('%Y%m%d')
+        else:
+            suffix = start.strftime('%Y%m%dT%H%M%SZ')
+
+        # Google Calendar's ids for instances.
+        return RecurringEventInstance(
+            '{}_{}'.format(self._id, suffix), self._title, start,
+            start + self._duration, self._all_day, self._plugin)
+
+
+class RecurrenceIndex(object):
+    """
+    Answers queries for the instances of recurring events, like
+    IntervalIndex does for single events. Exceptions (instances that were
+    cancelled or changed, and are then indexed as single events of their
+    own) are left out.
+
+    Instances are expanded a day at a time and memoised, so as the
+    displayed time frame moves along only the day that comes into view is
+    expanded. Days that have gone out of view are dropped.
+    """
+
+    BLOCK = datetime.timedelta(days=1)
+
+    def __init__(self):
+        # Maps keys to RecurringEvents.
+        self._events = {}
+        # Maps the keys of RecurringEvents to the original starts of their
+        # exceptions, and the keys of exceptions to (event key, start).
+        self._exception_starts = {}
+        self._exceptions = {}
+        # Maps the keys of RecurringEvents to dictionaries mapping blocks
+        # (days since EPOCH) to the instances starting in them.
+        self._instances = {}
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self._events)
+
+    def add_event(self, key, event):
+        """ Add a RecurringEvent, replacing any item with the same key. """
+        self.remove(key)
+        self._events[key] = event
+
+    def add_exception(self, key, event_key, original_start):
+        """
+        Add an exception, replacing any item with the same key.
+        :param key: The key of the exception.
+        :param event_key: The key of the RecurringEvent it is an exception
+        to (which may be added before or after the exception).
+        :param original_start: The start of the instance it replaces.
+        """
+        self.remove(key)
+        self._exceptions[key] = (event_key, original_start)
+        self._exception_starts.setdefault(event_key, set()).add(
+            original_start)
+        self._instances.pop(event_key, None)
+
+    def remove(self, key):
+        """ Remove the RecurringEvent or exception with key (if present). """
+        if self._events.pop(key, None) is not None:
+            self._instances.pop(key, None)
+
+        exception = self._exceptions.pop(key, None)
+        if exception is not None:
+            event_key, original_start = exception
+            starts = self._exception_starts[event_key]
+            starts.discard(original_start)
+            if not starts:
+                del self._exception_starts[event_key]
+            self._instances.pop(event_key, None)
+
+    def clear(self):
+        self._events = {}
+        self._exception_starts = {}
+        self._exceptions = {}
+        self._instances = {}
+
+    @staticmethod
+    def get_block(dt):
+        return (dt - EPOCH) // RecurrenceIndex.BLOCK
+
+    def get_blocks(self, key, event, first, last):
+        """
+        Return the memoised instances of event for the blocks from first to
+        last, expanding any that are missing in one go.
+        """
+        blocks = self._instances.setdefault(key, {})
+
+        for block in [b for b in blocks if b < first]:
+            del blocks[block]
+
+        missing = [b for b in range(first, last + 1) if b not in blocks]
+        self.hits += last + 1 - first - len(missing)
+        self.misses += len(missing)
+
+        if missing:
+            exception_starts = self._exception_starts.get(key, ())
+            expanded = dict((b, []) for b in missing)
+
+            for start in event.get_instance_starts(
+                    EPOCH + missing[0] * RecurrenceIndex.BLOCK,
+                    EPOCH + (missing[-1] + 1) * RecurrenceIndex.BLOCK):
+                block = RecurrenceIndex.get_block(start)
+                if block in expanded and start not in exception_starts:
+                    expanded[block].append(event.create_instance(start))
+
+            blocks.update(expanded)
+
+        return [blocks[b] for b in range(first, last + 1)]
+
+    def query(self, start, end):
+        """
+        Return the instances overlapping the time frame from start to end.
+        Instances that take no time are included if they are within the
+        time frame.
+        """
+        result = []
+
+        for key, event in self._events.items():
+
+            if event.start() >= end:
+                continue
+
+            first = RecurrenceIndex.get_block(
+                max(start - event.duration(), event.start()))
+            last = RecurrenceIndex.get_block(end)
+
+            for instances in self.get_blocks(key, event, first, last):
+                for instance in instances:
+                    if instance.start() < end and \
+                            (instance.end() > start or
+                             instance.start() >= start):
+                        result.append(instance)
+
+        return result
@@ -0,0 +1,192 @@
+import abc
+import asyncio
+import concurrent.futures
+import functools
+import threading
+
+import six
+
+import plugins.plugin as plugin
+
+
+class PluginRuntime(object):
+    """
+    Runs the coroutines of all AsyncPlugins on a single asyncio event loop in
+    one thread. Calls that block (such as requests made with the Google API
+    client) are run on a small thread pool shared by all plugins so that
+    they don't hold up the loop.
+    """
+
+    def __init__(self, max_workers=2):
+        """
+        Constructs a PluginRuntime.
+        :param max_workers: The number of threads for blocking calls.
+        """
+        self._loop = asyncio.new_event_loop()
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers)
+        self._thread = threading.Thread(target=self.run,
+                                        name='plugin-runtime', daemon=True)
+
+    def run(self):
+        asyncio.set_event_loop(self._loop)
+        try:
+            self._loop.run_forever()
+        finally:
+            self._loop.close()
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        """ Stop the loop and wait for any blocking calls to finish. """
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join()
+        self._executor.shutdown(wait=True)
+
+    def submit(self, coroutine):
+        """
+        Run a coroutine on the loop (from any thread).
+        :return: A concurrent.futures.Future for its result.
+        """
+        return asyncio.run_coroutine_threadsafe(coroutine, self._loop)
+
+    def call_soon(self, callback, *args):
+        """ Call callback on the loop's thread (from any thread). """
+        self._loop.call_soon_threadsafe(callback, *args)
+
+    async def run_blocking(self, fn, *args, **kwargs):
+        """ Call fn on the thread pool, without blocking the loop. """
+        return await self._loop.run_in_executor(
+            self._executor, functools.partial(fn, *args, **kwargs))
+
+
+# The runtime shared by all started plugins, and the number of them.
+_runtime = None
+_runtime_users = 0
+_runtime_lock = threading.Lock()
+
+
+def acquire_runtime():
+    """ Return the shared PluginRuntime, starting it if need be. """
+    global _runtime, _runtime_users
+
+    with _runtime_lock:
+        if _runtime is None:
+            _runtime = PluginRuntime()
+            _runtime.start()
+        _runtime_users += 1
+        return _runtime
+
+
+def release_runtime():
+    """ Stop the shared PluginRuntime once no plugin uses it any more. """
+    global _runtime, _runtime_users
+
+    with _runtime_lock:
+        _runtime_users -= 1
+        if _runtime_users == 0:
+            _runtime.stop()
+            _runtime = None
+
+
+@six.add_metaclass(abc.ABCMeta)
+class AsyncPlugin(plugin.Plugin):
+    """
+    A plugin whose data is refreshed by a coroutine on the shared
+    PluginRuntime rather than by a thread of its own.
+
+    Refreshes start once the time frame to display is known (see
+    set_window) and are repeated every get_refresh_interval() seconds (or
+    sooner, see wake). Stopping the plugin cancels the refresh in progress
+    and waits for it to unwind.
+    """
+
+    def __init__(self):
+        """
+        Constructs an AsyncPlugin.
+        """
+        plugin.Plugin.__init__(self)
+        self._runtime = None
+        self._task = None
+        self._wakeup = None
+        # The time frame last asked for, as a tuple (start, end). It is set
+        # from the UI thread and read on the loop, always as a whole.
+        self._window = None
+
+    @abc.abstractmethod
+    def refresh(self, start, end):
+        """
+        A coroutine that brings the plugin's data up to date for the time
+        frame from start to end (calling notify_listeners if it changed).
+        Blocking work should be done through run_blocking.
+        """
+        pass
+
+    @abc.abstractmethod
+    def get_refresh_interval(self):
+        """ Return the number of seconds between refreshes. """
+        pass
+
+    def set_window(self, start, end):
+        """
+        Set the time frame that is being displayed (from any thread). The
+        first refresh waits for this.
+        """
+        first = self._window is None
+        self._window = (start, end)
+
+        if first and self._runtime is not None:
+            self._runtime.call_soon(self.wake)
+
+    def wake(self):
+        """ Start the next refresh straight away (on the loop's thread). """
+        if self._wakeup is not None:
+            self._wakeup.set()
+
+    async def run_blocking(self, fn, *args, **kwargs):
+        """ Call fn on the runtime's thread pool. """
+        return await self._runtime.run_blocking(fn, *args, **kwargs)
+
+    async def run(self):
+        """ Refresh until cancelled. """
+        while True:
+            window = self._window
+
+            if window is not None:
+                try:
+                    await self.refresh(*window)
+                except asyncio.CancelledError:
+                    raise
+                except Exception as e:
+                    print('Failed to refresh {}: {}'.format(
+                        type(self).__name__, e))
+                timeout = self.get_refresh_interval()
+            else:
+                timeout = None
+
+            self._wakeup.clear()
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+
+    async def start_task(self):
+        self._wakeup = asyncio.Event()
+        self._task = asyncio.ensure_future(self.run())
+
+    async def cancel_task(self):
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._task = None
+
+    def start(self):
+        self._runtime = acquire_runtime()
+        self._runtime.submit(self.start_task()).result()
+
+    def stop(self):
+        self._runtime.submit(self.cancel_task()).result()
+        self._runtime = None
+        release_runtime()
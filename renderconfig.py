@@ -0,0 +1,202 @@
+import collections
+
+from common import Rectangle
+
+WEEKDAYS = ['monday', 'tuesday', 'wednesday', 'thursday', 'friday',
+            'saturday', 'sunday']
+
+FillStyle = collections.namedtuple("FillStyle", ["colour"])
+
+StrokeStyle = collections.namedtuple("StrokeStyle", ["colour", "line_width",
+    "dash_style", "line_cap"])
+
+ShapeStyle = collections.namedtuple("ShapeStyle", ["fill", "stroke"])
+
+FontStyle = collections.namedtuple("FontStyle", ["colour", "font_size",
+    "font_face", "height"])
+
+TickStyle = collections.namedtuple("TickStyle", ["fill", "stroke",
+    "depth_pc", "thickness_pc"])
+
+HandStyle = collections.namedtuple("HandStyle", ["fill", "stroke",
+    "front_depth_pc", "back_depth_pc", "front_thickness_pc",
+    "back_thickness_pc"])
+
+DayLabelPlacement = collections.namedtuple("DayLabelPlacement", ["offset",
+    "open_left", "open_right"])
+
+DayLabelsConfig = collections.namedtuple("DayLabelsConfig", ["width",
+    "height", "radius", "day_start_label", "day_end_label"])
+
+WeekdayStyle = collections.namedtuple("WeekdayStyle", ["stroke",
+    "label_background", "label_font"])
+
+WindowConfig = collections.namedtuple("WindowConfig", ["width", "height",
+    "background_colour"])
+
+AppHeadingConfig = collections.namedtuple("AppHeadingConfig",
+    ["bounding_box", "fill", "stroke", "text_fn", "font"])
+
+ClockConfig = collections.namedtuple("ClockConfig", ["bounding_box", "face",
+    "hour_ticks", "minute_ticks", "hour_hand", "minute_hand", "second_hand"])
+
+TimelineConfig = collections.namedtuple("TimelineConfig", ["bounding_box",
+    "thickness", "max_pixel_error", "columnar_events", "hit_tolerance",
+    "day_labels", "weekdays"])
+
+EventListConfig = collections.namedtuple("EventListConfig", ["bounding_box",
+    "today_header_text_fn", "tomorrow_header_text_fn",
+    "datetime_header_text_fn", "heading_font", "event_font",
+    "selected_event"])
+
+RenderConfig = collections.namedtuple("RenderConfig", ["timespan", "window",
+    "text_cache_max_bytes", "app_heading", "clock", "timeline",
+    "event_list"])
+
+
+class ConfigCompiler(object):
+    """
+    Turns the dotmap configuration (see config.py) into the immutable
+    records above. Every value is checked once here so the render path only
+    does plain attribute reads.
+    """
+
+    def get(self, node, path, key):
+        """ Return node[key], raising a ValueError if it is missing. """
+        if key not in node:
+            raise ValueError("Missing configuration value '{}{}'".format(
+                path, key))
+        return node[key]
+
+    def get_node(self, node, path, key):
+        """ Return node[key] and its path for use with get. """
+        return self.get(node, path, key), "{}{}.".format(path, key)
+
+    def compile_rectangle(self, node, path):
+        return Rectangle(*[self.get(node, path, key)
+                           for key in Rectangle._fields])
+
+    def compile_fill(self, node, path):
+        if not node:
+            return None
+        return FillStyle(tuple(self.get(node, path, 'colour')))
+
+    def compile_stroke(self, node, path):
+        if not node:
+            return None
+        dashes, offset = self.get(node, path, 'dash_style')
+        return StrokeStyle(tuple(self.get(node, path, 'colour')),
+                           self.get(node, path, 'line_width'),
+                           (tuple(dashes), offset),
+                           self.get(node, path, 'line_cap'))
+
+    def compile_shape(self, node, path):
+        return ShapeStyle(self.compile_fill(node.get('fill'), path + 'fill.'),
+                          self.compile_stroke(node.get('stroke'), path + 'stroke.'))
+
+    def compile_font(self, node, path):
+        return FontStyle(tuple(self.get(node, path, 'colour')),
+                         self.get(node, path, 'font_size'),
+                         tuple(self.get(node, path, 'font_face')),
+                         self.get(node, path, 'height'))
+
+    def compile_tick(self, node, path):
+        shape = self.compile_shape(node, path)
+        return TickStyle(shape.fill, shape.stroke,
+                         self.get(node, path, 'depth_pc'),
+                         self.get(node, path, 'thickness_pc'))
+
+    def compile_hand(self, node, path):
+        shape = self.compile_shape(node, path)
+        return HandStyle(shape.fill, shape.stroke,
+                         *[self.get(node, path, key)
+                           for key in HandStyle._fields[2:]])
+
+    def compile_window(self, node, path):
+        return WindowConfig(self.get(node, path, 'width'),
+                            self.get(node, path, 'height'),
+                            tuple(self.get(node, path, 'background_colour')))
+
+    def compile_app_heading(self, node, path):
+        shape = self.compile_shape(node, path)
+        return AppHeadingConfig(
+            self.compile_rectangle(*self.get_node(node, path, 'bounding_box')),
+            shape.fill, shape.stroke,
+            self.get(node, path, 'text_fn'),
+            self.compile_font(*self.get_node(node, path, 'font')))
+
+    def compile_clock(self, node, path):
+        return ClockConfig(
+            self.compile_rectangle(*self.get_node(node, path, 'bounding_box')),
+            self.compile_shape(*self.get_node(node, path, 'face')),
+            self.compile_tick(*self.get_node(node, path, 'hour_ticks')),
+            self.compile_tick(*self.get_node(node, path, 'minute_ticks')),
+            self.compile_hand(*self.get_node(node, path, 'hour_hand')),
+            self.compile_hand(*self.get_node(node, path, 'minute_hand')),
+            self.compile_hand(*self.get_node(node, path, 'second_hand')))
+
+    def compile_day_label_placement(self, node, path):
+        return DayLabelPlacement(*[self.get(node, path, key)
+                                   for key in DayLabelPlacement._fields])
+
+    def compile_timeline(self, node, path):
+        day_labels, day_labels_path = self.get_node(node, path, 'day_labels')
+        stroke_fn = self.get(node, path, 'stroke_fn')
+
+        # Precompute everything that depends on the day of the week.
+        weekdays = {}
+        for weekday in WEEKDAYS:
+            label, label_path = self.get_node(day_labels, day_labels_path, weekday)
+            weekdays[weekday] = WeekdayStyle(
+                self.compile_stroke(stroke_fn(weekday), path + 'stroke_fn.'),
+                self.compile_shape(*self.get_node(label, label_path, 'background')),
+                self.compile_font(*self.get_node(label, label_path, 'font')))
+
+        return TimelineConfig(
+            self.compile_rectangle(*self.get_node(node, path, 'bounding_box')),
+            self.get(node, path, 'thickness'),
+            self.get(node, path, 'max_pixel_error'),
+            self.get(node, path, 'columnar_events'),
+            self.get(node, path, 'hit_tolerance'),
+            DayLabelsConfig(
+                self.get(day_labels, day_labels_path, 'width'),
+                self.get(day_labels, day_labels_path, 'height'),
+                self.get(day_labels, day_labels_path, 'radius'),
+                self.compile_day_label_placement(
+                    *self.get_node(day_labels, day_labels_path, 'day_start_label')),
+                self.compile_day_label_placement(
+                    *self.get_node(day_labels, day_labels_path, 'day_end_label'))),
+            weekdays)
+
+    def compile_event_list(self, node, path):
+        heading, heading_path = self.get_node(node, path, 'heading')
+        event, event_path = self.get_node(node, path, 'event')
+        selected, selected_path = self.get_node(node, path, 'selected_event')
+        return EventListConfig(
+            self.compile_rectangle(*self.get_node(node, path, 'bounding_box')),
+            self.get(node, path, 'today_header_text_fn'),
+            self.get(node, path, 'tomorrow_header_text_fn'),
+            self.get(node, path, 'datetime_header_text_fn'),
+            self.compile_font(*self.get_node(heading, heading_path, 'font')),
+            self.compile_font(*self.get_node(event, event_path, 'font')),
+            self.compile_shape(*self.get_node(selected, selected_path,
+                                              'background')))
+
+    def compile(self, config):
+        text_cache, text_cache_path = self.get_node(config, '', 'text_cache')
+        return RenderConfig(
+            self.get(config, '', 'timespan'),
+            self.compile_window(*self.get_node(config, '', 'window')),
+            self.get(text_cache, text_cache_path, 'max_bytes'),
+            self.compile_app_heading(*self.get_node(config, '', 'app_heading')),
+            self.compile_clock(*self.get_node(config, '', 'clock')),
+            self.compile_timeline(*self.get_node(config, '', 'timeline')),
+            self.compile_event_list(*self.get_node(config, '', 'event_list')))
+
+
+def compile_config(config):
+    """
+    Validate the dotmap configuration and compile the parts used for
+    rendering into a RenderConfig.
+    """
+    return ConfigCompiler().compile(config)
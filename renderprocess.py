@@ -0,0 +1,295 @@
+import datetime
+import gc
+import multiprocessing
+import multiprocessing.shared_memory
+import time
+
+import cairocffi as cairo
+
+from compositor import STAGE_SECONDS
+
+import eventcolumns
+import plugins.plugin
+
+# Style for items whose plugin doesn't give them a clockface style.
+DEFAULT_STYLE = plugins.plugin.ClockfaceStyle(
+    (1, 0, 0, 1), 10, ([], 0), cairo.constants.LINE_CAP_ROUND, None)
+
+
+def create_snapshot(events, plugins):
+    """
+    Return a compact, picklable copy of the timeline items of a frame: a
+    list of tuples (plugin index, id, title, start, end, all day, style id)
+    with times in seconds since eventcolumns.EPOCH.
+    """
+    plugin_ids = dict((p, i) for i, p in enumerate(plugins))
+
+    return [(plugin_ids[e.plugin()], e.id(), e.title(),
+             eventcolumns.to_epoch_seconds(e.start()),
+             eventcolumns.to_epoch_seconds(e.end()),
+             bool(getattr(e, 'is_all_day_event', lambda: False)()),
+             e.plugin().get_clockface_style_id(e))
+            for e in events]
+
+
+class SnapshotTimelineItem(plugins.plugin.TimelineItem):
+    """ A timeline item restored from a snapshot in the render process. """
+
+    __slots__ = ('_id', '_title', '_start', '_end', '_all_day', '_style_id',
+                 '_plugin')
+
+    def __init__(self, values, plugin):
+        _, self._id, self._title, start, end, self._all_day, \
+            self._style_id = values
+        self._start = eventcolumns.EPOCH + datetime.timedelta(seconds=start)
+        self._end = eventcolumns.EPOCH + datetime.timedelta(seconds=end)
+        self._plugin = plugin
+        plugins.plugin.TimelineItem.__init__(self)
+
+    def id(self):
+        return self._id
+
+    def start(self):
+        return self._start
+
+    def end(self):
+        return self._end
+
+    def plugin(self):
+        return self._plugin
+
+    def title(self):
+        return self._title
+
+    def is_all_day_event(self):
+        return self._all_day
+
+    def style_id(self):
+        return self._style_id
+
+
+class SnapshotPlugin(plugins.plugin.Plugin):
+    """
+    Stands in for a plugin in the render process, where only its clockface
+    styles are known. Items without a style are drawn with DEFAULT_STYLE.
+    """
+
+    def __init__(self, styles):
+        plugins.plugin.Plugin.__init__(self)
+        self._styles = styles
+
+    def start(self):
+        pass
+
+    def stop(self):
+        pass
+
+    def get_timeline_items(self, start, end):
+        return []
+
+    def get_clockface_styles(self):
+        return self._styles
+
+    def get_clockface_style_id(self, timeline_item):
+        return timeline_item.style_id()
+
+    def render_on_clockface(self, cairo_context, start_utc, end_utc,
+                            timeline_item, point_generator, line_generator):
+        points = line_generator(max(start_utc, timeline_item.start()),
+                                min(end_utc, timeline_item.end()))
+
+        cairo_context.move_to(*points[0])
+        for point in points[1:]:
+            cairo_context.line_to(*point)
+
+        style = DEFAULT_STYLE
+        if self._styles and timeline_item.style_id() is not None:
+            style = self._styles[timeline_item.style_id()]
+
+        cairo_context.set_source_rgba(*style.colour)
+        cairo_context.set_line_width(style.line_width)
+        cairo_context.set_dash(*style.dash_style)
+        cairo_context.set_line_cap(style.line_cap)
+        cairo_context.stroke()
+
+        if style.end_cap_width is not None:
+            for t in (timeline_item.start(), timeline_item.end()):
+                cairo_context.move_to(*point_generator(t))
+                cairo_context.close_path()
+            cairo_context.set_line_width(style.end_cap_width)
+            cairo_context.set_dash([], 0)
+            cairo_context.set_line_cap(cairo.constants.LINE_CAP_ROUND)
+            cairo_context.stroke()
+
+
+def copy_regions(context, source, rects):
+    """ Copy rects of the source surface onto context. """
+    if not rects:
+        return
+
+    context.save()
+    context.set_operator(cairo.constants.OPERATOR_SOURCE)
+    context.set_source_surface(source, 0, 0)
+    for rect in rects:
+        context.rectangle(*rect)
+    context.fill()
+    context.restore()
+
+
+def run_worker(connection, create_renderer, styles, memory_name, width,
+               height, stride):
+    """
+    The render process. Frames are rendered alternately into the two
+    buffers in shared memory. Before a frame is rendered into a buffer the
+    areas that changed in the other buffer's frame are copied over, so that
+    the compositor can keep drawing only what changed. The first frame (and
+    any frame after the renderer is invalidated) damages the whole window,
+    so the copy gives the other buffer its background too.
+    """
+    memory = multiprocessing.shared_memory.SharedMemory(name=memory_name)
+    frame_bytes = stride * height
+
+    surfaces = [cairo.ImageSurface.create_for_data(
+        memory.buf[i * frame_bytes:(i + 1) * frame_bytes],
+        cairo.FORMAT_ARGB32, width, height, stride) for i in range(2)]
+    contexts = [cairo.Context(surface) for surface in surfaces]
+
+    snapshot_plugins = [SnapshotPlugin(s) for s in styles]
+    renderer = create_renderer(snapshot_plugins, surfaces[0])
+
+    back = 0
+    # The areas of the front buffer that differ from the back buffer.
+    pending_copy = []
+
+    try:
+        while True:
+            message = connection.recv()
+
+            if message[0] == 'events':
+                renderer.set_timeline_events(
+                    [SnapshotTimelineItem(values, snapshot_plugins[values[0]])
+                     for values in message[1]])
+
+            elif message[0] == 'render':
+                copy_regions(contexts[back], surfaces[1 - back], pending_copy)
+                damage = renderer.render(message[1], contexts[back])
+
+                # Both buffers hold the same frame unless something changed.
+                pending_copy = damage
+                connection.send(('frame', back, damage))
+
+                if damage:
+                    back = 1 - back
+
+            else:
+                break
+
+    finally:
+        # The surfaces must be gone before the memory can be closed (and the
+        # renderer's layers refer back to it, so collect the cycles too).
+        del renderer, contexts, surfaces
+        gc.collect()
+        memory.close()
+
+
+class RenderProcess(object):
+    """
+    Renders frames in a separate process so that plugin work (such as
+    decoding a big sync) doesn't compete with drawing for the interpreter.
+    The process is sent snapshots of the timeline items over a pipe and
+    renders into a double buffer in shared memory, which the display reads
+    finished frames from without copying them.
+
+    At most one frame is rendered at a time, requests made in the meantime
+    are merged into one.
+    """
+
+    def __init__(self, width, height, plugins, create_renderer):
+        """
+        Constructs a RenderProcess.
+        :param plugins: The plugins whose timeline items are passed to
+        set_timeline_events.
+        :param create_renderer: A callable taking a list of plugins and a
+        cairo surface and returning a Renderer, called in the render process.
+        """
+        self._plugins = plugins
+        self.stride = cairo.ImageSurface.format_stride_for_width(
+            cairo.FORMAT_ARGB32, width)
+        frame_bytes = self.stride * height
+
+        self._memory = multiprocessing.shared_memory.SharedMemory(
+            create=True, size=2 * frame_bytes)
+        self._frames = [self._memory.buf[i * frame_bytes:(i + 1) * frame_bytes]
+                        for i in range(2)]
+
+        self._connection, worker_connection = multiprocessing.Pipe()
+
+        styles = [p.get_clockface_styles() for p in plugins]
+
+        # Forked so that create_renderer (and the configuration it uses)
+        # needn't be picklable. Nothing in the render process touches the
+        # parent's windowing state.
+        self._process = multiprocessing.get_context('fork').Process(
+            target=run_worker, name='render',
+            args=(worker_connection, create_renderer, styles,
+                  self._memory.name, width, height, self.stride),
+            daemon=True)
+
+        self._snapshot = None
+        self._requested_at = None
+        self._pending = None
+
+    def start(self):
+        self._process.start()
+
+    def fileno(self):
+        """ The file descriptor that becomes readable when a frame is done. """
+        return self._connection.fileno()
+
+    def set_timeline_events(self, events):
+        """ Send events to the render process if they have changed. """
+        snapshot = create_snapshot(events, self._plugins)
+
+        if snapshot != self._snapshot:
+            self._snapshot = snapshot
+            self._connection.send(('events', snapshot))
+
+    def request_frame(self, now):
+        """ Ask for a frame for now to be rendered. """
+        if self._requested_at is not None:
+            self._pending = now
+            return
+
+        self._requested_at = time.perf_counter()
+        self._connection.send(('render', now))
+
+    def receive_frame(self):
+        """
+        Receive a finished frame (call when fileno is readable).
+        :return: A tuple (data, damage) where data is a buffer with the
+        frame's pixels (valid until the next frame is received) and damage is
+        a list of Rectangles that changed.
+        """
+        _, index, damage = self._connection.recv()
+
+        STAGE_SECONDS.observe(time.perf_counter() - self._requested_at,
+                              stage='render_process')
+        self._requested_at = None
+
+        if self._pending is not None:
+            now, self._pending = self._pending, None
+            self.request_frame(now)
+
+        return self._frames[index], damage
+
+    def stop(self):
+        try:
+            self._connection.send(('stop',))
+        except OSError:
+            pass
+        self._process.join()
+
+        for frame in self._frames:
+            frame.release()
+        self._memory.close()
+        self._memory.unlink()
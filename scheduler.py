@@ -0,0 +1,168 @@
+import collections
+import datetime
+import os
+import select
+import statistics
+
+# How much of the display is animated (see FramePacer).
+MINUTE_TICKS = 0
+ANIMATE_HANDS = 1
+ANIMATE_ALL = 2
+
+
+class FrameScheduler(object):
+    """
+    Works out when the next frame is due and provides a way for other
+    threads to ask for a frame straight away.
+
+    Without animation nothing on screen changes between minute boundaries
+    (the clock hands and the spiral have a resolution of one minute and the
+    heading changes at midnight, which is itself a minute boundary) so
+    frames are due at the start of each minute or when a plugin publishes
+    new data. When animating, a FramePacer brings the timeout forward to
+    the next animation frame (see wait's timeout).
+
+    Wake-ups are signalled through a pipe so that the scheduler can be
+    waited on with select or registered with an event loop such as Tk's.
+    """
+
+    # Aim slightly past each boundary so the new minute has definitely begun.
+    MARGIN = datetime.timedelta(milliseconds=10)
+
+    def __init__(self):
+        self._read_fd, self._write_fd = os.pipe()
+        os.set_blocking(self._read_fd, False)
+        os.set_blocking(self._write_fd, False)
+
+    def fileno(self):
+        """ The file descriptor that becomes readable when notified. """
+        return self._read_fd
+
+    def notify(self):
+        """ Request a frame as soon as possible (safe to call from any thread). """
+        try:
+            os.write(self._write_fd, b'\0')
+        except BlockingIOError:
+            # The pipe is full so a wake-up is already pending.
+            pass
+
+    def clear(self):
+        """ Discard any pending notifications. """
+        try:
+            while os.read(self._read_fd, 4096):
+                pass
+        except BlockingIOError:
+            pass
+
+    def next_deadline(self, now):
+        """ Return the datetime at which the next frame is due. """
+        next_minute = now.replace(second=0, microsecond=0) + \
+            datetime.timedelta(minutes=1)
+        next_midnight = now.replace(hour=0, minute=0, second=0, microsecond=0) + \
+            datetime.timedelta(days=1)
+
+        return min(next_minute, next_midnight) + self.MARGIN
+
+    def get_timeout(self, now):
+        """ Return the number of seconds from now until the next frame. """
+        return max(0.0, (self.next_deadline(now) - now).total_seconds())
+
+    def wait(self, timeout=None):
+        """
+        Block until the next frame is due or a notification arrives.
+        :param timeout: The number of seconds until the next frame, if it is
+        due before the next minute.
+        :return: True if woken by a notification.
+        """
+        minute_timeout = self.get_timeout(datetime.datetime.now())
+        if timeout is None or timeout > minute_timeout:
+            timeout = minute_timeout
+        readable, _, _ = select.select([self._read_fd], [], [], timeout)
+        self.clear()
+        return bool(readable)
+
+    def close(self):
+        os.close(self._read_fd)
+        os.close(self._write_fd)
+
+
+class FramePacer(object):
+    """
+    Paces the frames of the animation mode and picks how much of the display
+    is animated.
+
+    The cost of recent frames is measured and when it typically exceeds the
+    budget (a fraction of the time between frames) less is animated: first
+    only the hands and then nothing, leaving the minute ticks of
+    FrameScheduler. More is tried again after retry_interval seconds. Frames
+    that are already late when the previous one is done are dropped rather
+    than rendered in a burst.
+    """
+
+    def __init__(self, fps, budget=0.8, window=30, retry_interval=600):
+        """
+        Constructs a FramePacer.
+        :param fps: The target number of frames per second.
+        :param budget: The fraction of each frame's time that rendering and
+        presenting the frame may take.
+        :param window: The number of frames the typical cost is taken over.
+        :param retry_interval: Seconds before animating more again.
+        """
+        self._interval = 1.0 / fps
+        self._budget = self._interval * budget
+        self._costs = collections.deque(maxlen=window)
+        self._retry_interval = retry_interval
+        self._changed_at = None
+        self._next_frame = None
+        self.detail = ANIMATE_ALL
+
+    def set_detail(self, detail, now):
+        self.detail = detail
+        self._costs.clear()
+        self._changed_at = now
+
+    def frame_done(self, cost, now):
+        """
+        Record the cost of a frame and adapt the detail to it.
+        :param cost: The seconds taken to render and present the frame.
+        :param now: The current time.monotonic().
+        :return: True if the detail has changed.
+        """
+        self._costs.append(cost)
+
+        if self.detail > MINUTE_TICKS and \
+                len(self._costs) == self._costs.maxlen and \
+                statistics.median(self._costs) > self._budget:
+            self.set_detail(self.detail - 1, now)
+            return True
+
+        if self.detail < ANIMATE_ALL and \
+                now - self._changed_at >= self._retry_interval:
+            self.set_detail(self.detail + 1, now)
+            return True
+
+        return False
+
+    def schedule_next(self, now):
+        """
+        Work out when the next animation frame is due.
+        :param now: The current time.monotonic().
+        :return: A tuple (timeout, dropped) with the seconds until the next
+        frame (None if nothing is animated) and the number of frames dropped
+        because their time had already passed.
+        """
+        if self.detail == MINUTE_TICKS:
+            self._next_frame = None
+            return None, 0
+
+        if self._next_frame is None:
+            self._next_frame = now
+
+        self._next_frame += self._interval
+        dropped = 0
+
+        if self._next_frame < now:
+            dropped = int((now - self._next_frame) / self._interval) + 1
+            self._next_frame += dropped * self._interval
+
+        return self._next_frame - now, dropped
@@ -0,0 +1,178 @@
+import math
+
+import numpy
+
+
+class SpiralTessellator(object):
+    """
+    Turns ranges of the spiral described by
+        x = (a * t + b) * math.sin(c * t + d)
+        y = (a * t + b) * math.cos(c * t + d)
+    into polylines. Instead of stepping t by a fixed amount the step is
+    picked per segment such that the distance between the polyline and the
+    true curve stays below max_pixel_error, so the wide outer turns get more
+    samples than the tight inner ones. All segments of a frame are computed
+    in a single batch of NumPy operations.
+    """
+
+    def __init__(self, centre, max_pixel_error=0.25, min_step=0.005,
+                 max_step=0.5):
+        """
+        Constructs a SpiralTessellator.
+        :param centre: The (x, y) point the spiral is centred on.
+        :param max_pixel_error: The maximum deviation from the true curve, in
+        pixels.
+        :param min_step: The smallest allowed increment in t.
+        :param max_step: The largest allowed increment in t.
+        """
+        self._centre = centre
+        self._max_pixel_error = max_pixel_error
+        self._min_step = min_step
+        self._max_step = max_step
+
+    def get_steps(self, spiral_params, t_from, t_to):
+        """
+        Return the increment in t to use for each (t_from, t_to) range.
+        """
+        a, b, c, _ = spiral_params
+
+        # The worst case is at the point on each range furthest from the
+        # centre, where a chord spanning the same angle strays the most.
+        r = numpy.maximum(numpy.abs(a * t_from + b), numpy.abs(a * t_to + b))
+        r2 = r * r
+        a2 = a * a
+
+        # Curvature of an Archimedean spiral and the rate at which its
+        # tangent turns per unit of t.
+        curvature = (r2 + 2 * a2) / numpy.power(r2 + a2, 1.5)
+        turn_rate = abs(c) * (r2 + 2 * a2) / (r2 + a2)
+
+        # Largest tangent angle a chord can span with the error bounded by
+        # max_pixel_error (the sagitta of an arc with the same curvature).
+        cos_half = numpy.clip(1 - self._max_pixel_error * curvature, -1, 1)
+        max_angle = 2 * numpy.arccos(cos_half)
+
+        return numpy.clip(max_angle / turn_rate, self._min_step, self._max_step)
+
+    def get_samples(self, spiral_params, t_from, t_to):
+        """
+        Pick the values of t at which to sample many ranges of the spiral.
+        :return: A tuple (t, offsets) where t is an array with the samples of
+        all ranges concatenated (each including both ends of its range) and
+        offsets holds the index one past the last sample of each range.
+        """
+        t_to = numpy.asarray(t_to, dtype=float)
+        t_from = numpy.minimum(numpy.asarray(t_from, dtype=float), t_to)
+
+        steps = self.get_steps(spiral_params, t_from, t_to)
+        intervals = numpy.maximum(
+            numpy.ceil((t_to - t_from) / steps), 1).astype(int)
+        counts = intervals + 1
+        offsets = numpy.cumsum(counts)
+        first = offsets - counts
+
+        # Index of each sample within its own range.
+        index = numpy.arange(offsets[-1]) - numpy.repeat(first, counts)
+        t = numpy.repeat(t_from, counts) + index * numpy.repeat(
+            (t_to - t_from) / intervals, counts)
+
+        return t, offsets
+
+    def get_points(self, spiral_params, t):
+        """ Return an (n, 2) array with the point for each value in t. """
+        a, b, c, d = spiral_params
+        t = numpy.asarray(t, dtype=float)
+
+        scalar = a * t + b
+        angle = c * t + d
+
+        points = numpy.empty((len(t), 2))
+        points[:, 0] = self._centre[0] + scalar * numpy.sin(angle)
+        points[:, 1] = self._centre[1] + scalar * numpy.cos(angle)
+
+        return points
+
+
+class SpiralGeometry(object):
+    """
+    A tessellation of the spiral between t=0 and t=t_max that is computed
+    once and then sliced. The geometry is kept in the spiral's own frame
+    (centred on the origin with no phase) so a single rotation maps it onto
+    the clock face at any time of day.
+    """
+
+    # Ranges are tessellated per turn so the outer turns don't dictate the
+    # step used for the inner ones.
+    TURN = 2 * math.pi
+
+    def __init__(self, tessellator, spiral_params, t_max):
+        """
+        Constructs a SpiralGeometry.
+        :param tessellator: A SpiralTessellator centred on the origin.
+        :param spiral_params: The (a, b, c, d) parameters of the spiral.
+        :param t_max: The end of the spiral.
+        """
+        self._tessellator = tessellator
+        self._spiral_params = spiral_params
+        self._t_max = t_max
+
+        edges = numpy.append(numpy.arange(0, t_max, SpiralGeometry.TURN), t_max)
+        t, offsets = tessellator.get_samples(spiral_params, edges[:-1], edges[1:])
+
+        # Drop the duplicate sample where two turns meet.
+        duplicates = offsets[:-1]
+        self._t = numpy.delete(t, duplicates)
+        self._points = tessellator.get_points(spiral_params, self._t)
+
+    def t_max(self):
+        return self._t_max
+
+    def get_points(self, t):
+        """ Return an (n, 2) array with the point for each value in t. """
+        return self._tessellator.get_points(self._spiral_params, t)
+
+    def slices(self, t_from, t_to):
+        """
+        Cut many ranges out of the cached geometry.
+        :param t_from: A sequence with the start of each range.
+        :param t_to: A sequence with the end of each range.
+        :return: A list with, for each range, an (n, 2) array of points with
+        n >= 2 that starts and ends exactly at the range's ends.
+        """
+        if len(t_to) == 0:
+            return []
+
+        points, offsets = self.slices_flat(t_from, t_to)
+        return numpy.split(points, offsets[:-1])
+
+    def slices_flat(self, t_from, t_to):
+        """
+        Like slices but without splitting the result per range.
+        :return: A tuple (points, offsets) where points is an (n, 2) array
+        with the points of all ranges concatenated and offsets holds the index
+        one past the last point of each range.
+        """
+        t_to = numpy.asarray(t_to, dtype=float)
+        t_from = numpy.minimum(numpy.asarray(t_from, dtype=float), t_to)
+
+        first = numpy.searchsorted(self._t, t_from, side='right')
+        last = numpy.maximum(
+            numpy.searchsorted(self._t, t_to, side='left'), first)
+
+        # Each range gets its two exact end points plus the cached samples
+        # that lie strictly between them.
+        inner_counts = last - first
+        counts = inner_counts + 2
+        offsets = numpy.cumsum(counts)
+        starts = offsets - counts
+
+        points = numpy.empty((offsets[-1] if len(offsets) else 0, 2))
+        points[starts] = self.get_points(t_from)
+        points[offsets - 1] = self.get_points(t_to)
+
+        inner_index = numpy.arange(inner_counts.sum()) - numpy.repeat(
+            numpy.cumsum(inner_counts) - inner_counts, inner_counts)
+        points[numpy.repeat(starts + 1, inner_counts) + inner_index] = \
+            self._points[numpy.repeat(first, inner_counts) + inner_index]
+
+        return points, offsets
@@ -0,0 +1,174 @@
+"""
+Tests of GoogleCalendarPlugin.get_events against the in-memory stand-in for
+the Google Calendar API in benchmarks/synthetic.py. Run from the
+repository's root directory:
+
+    python3 -m pytest tests
+"""
+
+import datetime
+import os
+import shutil
+import tempfile
+import unittest
+
+import dotmap
+
+import plugins.googlecalendarplugin as googlecalendarplugin
+
+from benchmarks import synthetic
+
+START = datetime.datetime(2018, 1, 1)
+END = START + datetime.timedelta(days=1)
+
+
+def create_event(event_id, start, status='confirmed'):
+    """ Return the resource of an hour long event. """
+    return {'id': event_id,
+            'status': status,
+            'summary': 'Event {}'.format(event_id),
+            'start': {'dateTime': start.strftime(synthetic.STRFTIME_FMT)},
+            'end': {'dateTime': (start + datetime.timedelta(hours=1))
+                    .strftime(synthetic.STRFTIME_FMT)}}
+
+
+class GetEventsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.service = synthetic.StubService({
+            'a@example.com': [
+                create_event('a1', START + datetime.timedelta(hours=1)),
+                create_event('a2', START + datetime.timedelta(hours=3))],
+            'b@example.com': [
+                create_event('b1', START + datetime.timedelta(hours=2))]})
+        self.calendars = self.service.calendars()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def create_plugin(self, event_store_file=None):
+        # One event per page so that every sync is paged.
+        plug = googlecalendarplugin.GoogleCalendarPlugin(dotmap.DotMap({
+            'page_size': 1,
+            'sync_horizon_in_days': 14,
+            'event_store_file': event_store_file}))
+        plug.load_store()
+        return plug
+
+    def sync(self, plug, calendars=None):
+        """ Sync plug and return the ids of the events it returned. """
+        items = plug.get_events(self.service, calendars or self.calendars,
+                                START, END)
+        return sorted(item.id() for item in items)
+
+    @staticmethod
+    def get_timeline_ids(plug):
+        return sorted(item.id() for item in plug.get_timeline_items(START, END))
+
+    def test_full_sync(self):
+        plug = self.create_plugin()
+
+        self.assertEqual(self.sync(plug), ['a1', 'a2', 'b1'])
+        self.assertEqual(self.get_timeline_ids(plug), ['a1', 'a2', 'b1'])
+        self.assertEqual(plug._errors, {})
+
+    def test_incremental_sync_applies_changes_and_cancellations(self):
+        plug = self.create_plugin()
+        self.sync(plug)
+
+        moved = create_event('a1', START + datetime.timedelta(hours=5))
+        self.service.change_event('a@example.com', moved)
+        self.service.change_event(
+            'a@example.com', create_event('a2', START, status='cancelled'))
+        self.service.change_event(
+            'b@example.com', create_event('b2', START))
+
+        round_trips = self.service.round_trips
+        self.assertEqual(self.sync(plug), ['a1', 'b1', 'b2'])
+        self.assertEqual(self.get_timeline_ids(plug), ['a1', 'b1', 'b2'])
+
+        # Only the changes were fetched, a page per change in the busiest
+        # calendar.
+        self.assertEqual(self.service.round_trips - round_trips, 2)
+
+        a1, = [item for item in plug.get_timeline_items(START, END)
+               if item.id() == 'a1']
+        self.assertEqual(a1.start(), START + datetime.timedelta(hours=5))
+
+    def test_expired_sync_token_starts_a_full_sync(self):
+        plug = self.create_plugin()
+        self.sync(plug)
+
+        self.service.change_event(
+            'a@example.com', create_event('a2', START, status='cancelled'))
+        self.service.expire_sync_tokens()
+
+        retries = googlecalendarplugin.API_RETRIES.value(
+            reason='sync_token_expired')
+        self.assertEqual(self.sync(plug), ['a1', 'b1'])
+        self.assertEqual(self.get_timeline_ids(plug), ['a1', 'b1'])
+        self.assertEqual(plug._errors, {})
+        self.assertEqual(googlecalendarplugin.API_RETRIES.value(
+            reason='sync_token_expired'), retries + 2)
+
+        # The new sync tokens work.
+        self.service.change_event(
+            'b@example.com', create_event('b2', START))
+        self.assertEqual(self.sync(plug), ['a1', 'b1', 'b2'])
+
+    def test_failing_calendar_keeps_its_events(self):
+        plug = self.create_plugin()
+        self.sync(plug)
+
+        self.service.change_event(
+            'b@example.com', create_event('b2', START))
+        self.service.set_error('a@example.com', 404)
+
+        self.assertEqual(self.sync(plug), ['a1', 'a2', 'b1', 'b2'])
+        self.assertEqual(list(plug._errors), ['a@example.com'])
+        self.assertEqual(plug._errors['a@example.com'].resp.status, 404)
+
+        # The calendar syncs again once it is back.
+        self.service.set_error('a@example.com', None)
+        self.service.change_event(
+            'a@example.com', create_event('a2', START, status='cancelled'))
+        self.assertEqual(self.sync(plug), ['a1', 'b1', 'b2'])
+        self.assertEqual(plug._errors, {})
+
+    def test_unknown_calendar_is_isolated(self):
+        plug = self.create_plugin()
+        calendars = self.calendars + [{'id': 'missing@example.com',
+                                       'selected': True}]
+
+        self.assertEqual(self.sync(plug, calendars), ['a1', 'a2', 'b1'])
+        self.assertEqual(list(plug._errors), ['missing@example.com'])
+
+    def test_event_store_round_trip(self):
+        path = os.path.join(self.directory, 'events.sqlite')
+
+        plug = self.create_plugin(path)
+        self.sync(plug)
+        self.service.change_event(
+            'a@example.com', create_event('a2', START, status='cancelled'))
+        self.sync(plug)
+        sync_tokens = dict(plug._sync_tokens)
+        plug._store.close()
+
+        # A new run shows the saved events before syncing.
+        plug = self.create_plugin(path)
+        self.assertEqual(self.get_timeline_ids(plug), ['a1', 'b1'])
+        self.assertEqual(plug._sync_tokens, sync_tokens)
+
+        # And carries on from the saved sync tokens.
+        self.service.change_event(
+            'b@example.com', create_event('b2', START))
+        retries = googlecalendarplugin.API_RETRIES.value(
+            reason='sync_token_expired')
+        self.assertEqual(self.sync(plug), ['a1', 'b1', 'b2'])
+        self.assertEqual(googlecalendarplugin.API_RETRIES.value(
+            reason='sync_token_expired'), retries)
+        plug._store.close()
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,109 @@
+import collections
+import math
+
+import cairocffi as cairo
+
+import metrics
+
+TEXT_CACHE_HITS = metrics.REGISTRY.counter(
+    'calendar_text_cache_hits_total',
+    'Strings drawn from an already rasterised sprite.')
+
+TEXT_CACHE_MISSES = metrics.REGISTRY.counter(
+    'calendar_text_cache_misses_total',
+    'Strings that had to be rasterised into a new sprite.')
+
+TextSprite = collections.namedtuple("TextSprite", ["surface", "extents",
+    "x_origin", "y_origin"])
+
+
+class TextSpriteCache(object):
+    """
+    A least-recently-used cache of strings rasterised into small surfaces,
+    keyed by the text, font and colour. Drawing a cached string is a single
+    blit instead of a font lookup, a measurement and glyph rendering.
+    """
+
+    # Transparent border around the glyphs so antialiased edges aren't
+    # cut off when the sprite is blitted at an angle.
+    PADDING = 2
+
+    def __init__(self, max_bytes):
+        """
+        Constructs a TextSpriteCache.
+        :param max_bytes: The most pixel memory the cached sprites may use
+        before the least recently used ones are dropped.
+        """
+        self._max_bytes = max_bytes
+        self._sprites = collections.OrderedDict()
+        self._bytes = 0
+        self.hits = 0
+        self.misses = 0
+
+        # Used to measure text before a sprite of the right size exists.
+        self._scratch = cairo.Context(
+            cairo.ImageSurface(cairo.FORMAT_ARGB32, 1, 1))
+
+    def __len__(self):
+        return len(self._sprites)
+
+    def size_in_bytes(self):
+        return self._bytes
+
+    @staticmethod
+    def set_font(context, text_params):
+        context.select_font_face(*text_params.font_face)
+        context.set_font_size(text_params.font_size)
+
+    def get(self, text, text_params):
+        """ Return the TextSprite for text drawn with text_params. """
+        key = (text, text_params.font_size, tuple(text_params.font_face),
+               tuple(text_params.colour))
+
+        sprite = self._sprites.get(key)
+
+        if sprite is not None:
+            self._sprites.move_to_end(key)
+            self.hits += 1
+            TEXT_CACHE_HITS.inc()
+            return sprite
+
+        self.misses += 1
+        TEXT_CACHE_MISSES.inc()
+        sprite = self.render(text, text_params)
+        self._sprites[key] = sprite
+        self._bytes += self.get_sprite_bytes(sprite)
+
+        while self._bytes > self._max_bytes and len(self._sprites) > 1:
+            _, evicted = self._sprites.popitem(last=False)
+            self._bytes -= self.get_sprite_bytes(evicted)
+
+        return sprite
+
+    @staticmethod
+    def get_sprite_bytes(sprite):
+        return sprite.surface.get_stride() * sprite.surface.get_height()
+
+    def render(self, text, text_params):
+        """ Rasterise text into a new TextSprite. """
+        TextSpriteCache.set_font(self._scratch, text_params)
+        extents = self._scratch.text_extents(text)
+        x_bearing, y_bearing, w, h, _, _ = extents
+
+        pad = TextSpriteCache.PADDING
+        width = max(1, int(math.ceil(w)) + 2 * pad)
+        height = max(1, int(math.ceil(h)) + 2 * pad)
+
+        # Position of the text's origin within the sprite.
+        x_origin = pad - x_bearing
+        y_origin = pad - y_bearing
+
+        surface = cairo.ImageSurface(cairo.FORMAT_ARGB32, width, height)
+        context = cairo.Context(surface)
+        TextSpriteCache.set_font(context, text_params)
+        context.set_source_rgba(*text_params.colour)
+        context.move_to(x_origin, y_origin)
+        context.show_text(text)
+        surface.flush()
+
+        return TextSprite(surface, extents, x_origin, y_origin)